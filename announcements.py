@@ -0,0 +1,45 @@
+"""Per-worker cache of the current announcement.
+
+The cached entry carries a version (the message id) used as the ETag, so
+every worker hands out the same validator for the same announcement.
+/admin/add-message and /admin/delete-message call announcement_changed(),
+which notifies all workers to drop their copy when the write commits.
+"""
+import os
+from collections import namedtuple
+
+from db import get_db
+from notify import CachedValue, publish
+
+ANNOUNCEMENT_TTL = float(os.getenv("ANNOUNCEMENT_TTL", "300"))
+ANNOUNCEMENT_CHANNEL = "announcement_changed"
+
+Announcement = namedtuple("Announcement", "etag last_modified payload")
+
+
+def _load():
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, title, content, created_at FROM messages ORDER BY created_at DESC LIMIT 1")
+        row = cur.fetchone()
+
+    if not row:
+        return Announcement("none", None, {})  # No announcement available
+    return Announcement(f"m{row[0]}", row[3], {
+        "title": row[1],
+        "content": row[2],
+        "created_at": row[3].isoformat()
+    })
+
+
+_announcement = CachedValue(ANNOUNCEMENT_CHANNEL, _load, ANNOUNCEMENT_TTL)
+
+
+def get_announcement():
+    return _announcement.get()
+
+
+def announcement_changed(cur):
+    # Call inside the writing transaction; other workers hear about it on commit.
+    publish(cur, ANNOUNCEMENT_CHANNEL)
+    _announcement.invalidate()
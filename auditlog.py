@@ -0,0 +1,230 @@
+"""Buffered writer for user_logs audit events.
+
+record() only appends to an in-memory ring buffer, so hot routes never
+wait on (or hold) a database connection for auditing. A background thread
+per worker drains the buffer with one COPY per batch, as soon as
+AUDIT_BATCH_SIZE events are waiting or every AUDIT_FLUSH_INTERVAL seconds.
+
+Loss is bounded: the buffer holds at most AUDIT_BUFFER_SIZE events. If
+the database falls behind or is down, the oldest events are dropped to
+make room (and counted in audit_stats()), and a batch that could not
+reach the database is put back and retried with backoff. A batch the
+database refuses is split until the offending event is isolated; that
+one is dropped and counted, the rest are written. Whatever is still buffered when the process
+exits is flushed once, best effort.
+
+user_logs is partitioned by month. The writer keeps partitions created
+AUDIT_PARTITIONS_AHEAD months ahead and, if AUDIT_RETENTION_MONTHS is set,
+drops whole partitions older than that instead of deleting rows.
+"""
+import atexit
+import csv
+import io
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import psycopg2
+
+from db import PoolTimeout, get_db
+from perprocess import per_process
+
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "50000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "1000"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))
+AUDIT_RETRY_BACKOFF = float(os.getenv("AUDIT_RETRY_BACKOFF", "1"))      # seconds, doubled per failure
+AUDIT_RETENTION_MONTHS = int(os.getenv("AUDIT_RETENTION_MONTHS", "0"))  # 0 = keep everything
+AUDIT_PARTITIONS_AHEAD = 2
+AUDIT_MAINTENANCE_INTERVAL = 6 * 3600
+
+# pg advisory lock key so only one worker creates or drops partitions at a time
+AUDIT_PARTITION_LOCK_KEY = 7203
+
+
+def _month(year, month):
+    # Normalises month overflow/underflow, e.g. (2024, 14) -> 2025-02-01
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1)
+
+
+def partition_name(start):
+    return f"user_logs_{start:%Y_%m}"
+
+
+def ensure_partitions(cur, now, ahead=AUDIT_PARTITIONS_AHEAD):
+    """Create monthly partitions from this month to ``ahead`` months out."""
+    for i in range(ahead + 1):
+        start = _month(now.year, now.month + i)
+        end = _month(start.year, start.month + 1)
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(start)}
+            PARTITION OF user_logs FOR VALUES FROM (%s) TO (%s)
+        """, (start, end))
+
+
+def drop_partitions(cur, now, keep_months):
+    """Drop monthly partitions that end before the last ``keep_months`` months."""
+    cutoff = partition_name(_month(now.year, now.month - keep_months))
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_logs'::regclass AND c.relname ~ '^user_logs_[0-9]{4}_[0-9]{2}$'
+    """)
+    # Names sort chronologically
+    old = sorted(name for (name,) in cur.fetchall() if name < cutoff)
+    for name in old:
+        cur.execute(f"DROP TABLE {name}")
+    return old
+
+
+class AuditWriter:
+    """Batches events from a bounded ring buffer into user_logs from a background thread."""
+
+    def __init__(self, maxsize=AUDIT_BUFFER_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, backoff=AUDIT_RETRY_BACKOFF):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+
+        self._buffer = deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._maintained_at = None
+        self._stats = {
+            "recorded": 0,
+            "written": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+        }
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, user_id, action, at=None):
+        event = (user_id, action, at or datetime.utcnow())
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._stats["dropped"] += 1  # deque drops the oldest
+            self._buffer.append(event)
+            self._stats["recorded"] += 1
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._buffer)
+        return stats
+
+    def flush(self):
+        """Write everything buffered now; returns False if a batch failed."""
+        while True:
+            with self._cond:
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not batch:
+                return True
+            if not self._write(batch):
+                return False
+
+    # --- worker loop ---
+
+    def _write(self, batch):
+        """COPY ``batch`` into user_logs; returns False if it was put back to retry."""
+        parts = [batch]     # stack, earliest events on top
+        while parts:
+            part = parts.pop()
+            try:
+                self._copy(part)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout) as e:
+                # Database unreachable: put back what is left and retry with backoff
+                print("Audit log flush error:", e)
+                self._requeue(part + [event for rest in reversed(parts) for event in rest])
+                self._failures += 1
+                return False
+            except Exception as e:
+                # Something in the events themselves: halve the part until the
+                # bad event is alone, write the rest and drop that one
+                with self._cond:
+                    self._stats["flush_errors"] += 1
+                if len(part) == 1:
+                    print("Audit log event dropped:", part[0], e)
+                    with self._cond:
+                        self._stats["dropped"] += 1
+                    continue
+                middle = len(part) // 2
+                parts += [part[middle:], part[:middle]]
+                continue
+            with self._cond:
+                self._stats["written"] += len(part)
+                self._stats["flushes"] += 1
+        self._failures = 0
+        return True
+
+    def _copy(self, events):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for user_id, action, at in events:
+            writer.writerow(("" if user_id is None else user_id, action, at.isoformat()))
+        buf.seek(0)
+        with get_db() as conn:
+            cur = conn.cursor()
+            self._maintain(cur)
+            cur.copy_expert("COPY user_logs (user_id, action, created_at) FROM STDIN WITH (FORMAT csv)", buf)
+            conn.commit()
+
+    def _requeue(self, events):
+        with self._cond:
+            self._stats["flush_errors"] += 1
+            # Back in front; anything past capacity falls off the old end
+            room = self._buffer.maxlen - len(self._buffer)
+            self._stats["dropped"] += max(len(events) - room, 0)
+            self._buffer.extendleft(reversed(events[-room:] if room else []))
+
+    def _maintain(self, cur):
+        if self._maintained_at is not None and time.monotonic() - self._maintained_at < AUDIT_MAINTENANCE_INTERVAL:
+            return
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (AUDIT_PARTITION_LOCK_KEY,))
+        if cur.fetchone()[0]:
+            now = datetime.utcnow()
+            ensure_partitions(cur, now)
+            if AUDIT_RETENTION_MONTHS:
+                for name in drop_partitions(cur, now, AUDIT_RETENTION_MONTHS):
+                    print("Dropped audit log partition", name)
+        self._maintained_at = time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            try:
+                ok = self.flush()
+            except Exception as e:
+                print("Audit log writer error:", e)
+                self._failures += 1
+                ok = False
+            if not ok:
+                time.sleep(min(self.backoff * (2 ** (self._failures - 1)), 60))
+
+
+@per_process
+def get_writer():
+    # One writer thread per worker process, started on first use.
+    return AuditWriter()
+
+
+def record(user_id, action):
+    get_writer().record(user_id, action)
+
+
+def audit_stats():
+    return get_writer().stats()
+
+
+@atexit.register
+def _flush_on_exit():
+    writer = get_writer.current()
+    if writer is not None:
+        writer.flush()
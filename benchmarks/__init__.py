@@ -0,0 +1,10 @@
+"""Benchmarks and the load-test harness.
+
+    python benchmarks/seed.py --users 100000       # synthetic data in DATABASE_URL
+    python benchmarks/smtp_sink.py                 # fake SMTP server for the app
+    python benchmarks/loadtest.py --users 100000   # replay traffic, report p50/p95/p99
+    python benchmarks/prepared_statements.py --users 100000   # plain vs prepared hot queries
+
+See each module for options. The microbenchmarks (satoshi_arith.py,
+metrics_overhead.py) need neither a database nor a running server.
+"""
@@ -0,0 +1,14 @@
+"""Who the bench users are; shared by seed.py and loadtest.py."""
+
+BENCH_PASSWORD = "bench-Passw0rd!"
+BENCH_PIN = "1234"
+BENCH_EMAIL_LIKE = "bench-%@example.test"
+
+
+def bench_email(n):
+    return f"bench-{n}@example.test"
+
+
+def is_suspended(n):
+    # Every hundredth bench user, so the suspended paths see some traffic too
+    return n % 100 == 99
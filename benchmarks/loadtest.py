@@ -0,0 +1,210 @@
+"""Replay a traffic mix against a running app and report latency per route.
+
+    python benchmarks/loadtest.py --users 100000 --concurrency 32 --duration 60 --json after.json
+    python benchmarks/loadtest.py --users 100000 --baseline before.json
+
+Needs users from seed.py (same --users) and an app started with rate
+limits off, or claims and logins will be answered with 429:
+
+    RATE_LIMIT_OTP= RATE_LIMIT_CLAIM= gunicorn -w 4 server:app
+
+Each of --concurrency threads plays one user at a time over a keep-alive
+connection. It logs in (password, then PIN for a session token) and then
+picks requests by --mix weight; a "login" pick switches to a fresh
+user. Threads are seeded from --seed, so the same arguments replay the
+same request sequence. Reports requests, throughput and p50/p95/p99 per
+route; --json saves the report and --baseline prints the change against
+a saved one.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import quote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.fixtures import BENCH_PASSWORD, BENCH_PIN, bench_email, is_suspended  # noqa: E402
+
+DEFAULT_MIX = "login=5,claim=15,mine_sync=35,dashboard=35,admin_users=5,admin_withdrawals=5"
+
+
+class Client:
+    """One keep-alive connection; reconnects after errors."""
+
+    def __init__(self, base_url, timeout):
+        url = urlsplit(base_url)
+        self.host, self.port, self.timeout = url.hostname, url.port or 80, timeout
+        self.conn = None
+        self.token = None
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        # bytes, so http.client sends headers and body in one write
+        payload = json.dumps(body).encode() if body is not None else None
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, payload, headers)
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    return 0, b""   # counted as a connection error
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, args, mix, deadline):
+        super().__init__(name=f"loadtest-{index}", daemon=True)
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.args = args
+        self.mix = mix
+        self.deadline = deadline
+        self.client = Client(args.base_url, args.timeout)
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.remaining = args.requests // args.concurrency if args.requests else None
+
+    def timed(self, route, method, path, body=None):
+        started = time.perf_counter()
+        status, payload = self.client.request(method, path, body)
+        self.latencies[route].append(time.perf_counter() - started)
+        self.statuses[route][status] += 1
+        return status, payload
+
+    def login(self):
+        n = self.rng.randrange(self.args.users)
+        while is_suspended(n):
+            n = self.rng.randrange(self.args.users)
+        self.email = bench_email(n)
+        self.client.token = None
+        self.timed("login", "POST", "/user/login", {"email": self.email, "password": BENCH_PASSWORD})
+        status, payload = self.timed("login_pin", "POST", "/user/verify-login-pin",
+                                     {"email": self.email, "pin": BENCH_PIN})
+        if status == 200:
+            self.client.token = json.loads(payload).get("token")
+
+    def step(self, action):
+        if action == "login":
+            self.login()
+        elif action == "claim":
+            self.timed("claim", "POST", "/user/claim-hashrate", {"email": self.email})
+        elif action == "mine_sync":
+            self.timed("mine_sync", "POST", "/user/mine-sync", {"email": self.email})
+        elif action == "dashboard":
+            # The email too, for builds that predate session tokens
+            self.timed("dashboard", "GET", f"/user/dashboard?email={quote(self.email)}")
+        elif action == "admin_users":
+            self.timed("admin_users", "GET", f"/admin/users?limit=100&after_id={self.rng.randrange(self.args.users)}")
+        elif action == "admin_withdrawals":
+            self.timed("admin_withdrawals", "GET", "/admin/withdrawal-requests?limit=100")
+
+    def run(self):
+        actions, weights = zip(*self.mix.items())
+        self.login()
+        while time.monotonic() < self.deadline and self.remaining != 0:
+            self.step(self.rng.choices(actions, weights)[0])
+            if self.remaining is not None:
+                self.remaining -= 1
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        action, _, weight = part.partition("=")
+        mix[action.strip()] = float(weight)
+    return mix
+
+
+def percentile(ordered, p):
+    # Nearest rank
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def build_report(workers, elapsed):
+    latencies, statuses = defaultdict(list), defaultdict(Counter)
+    for worker in workers:
+        for route, values in worker.latencies.items():
+            latencies[route].extend(values)
+        for route, counts in worker.statuses.items():
+            statuses[route].update(counts)
+
+    report = {"elapsed_seconds": elapsed, "routes": {}}
+    for route in sorted(latencies):
+        ordered = sorted(latencies[route])
+        report["routes"][route] = {
+            "requests": len(ordered),
+            "rps": len(ordered) / elapsed,
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p95_ms": percentile(ordered, 95) * 1000,
+            "p99_ms": percentile(ordered, 99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "errors": sum(c for s, c in statuses[route].items() if not 200 <= s < 300),
+            "statuses": {str(s): c for s, c in sorted(statuses[route].items())},
+        }
+    return report
+
+
+def print_report(report, baseline=None):
+    def change(route, key, value):
+        old = (baseline or {}).get("routes", {}).get(route, {}).get(key)
+        return f" ({(value - old) / old * 100:+.0f}%)" if old else ""
+
+    print(f"\n{'route':<18} {'reqs':>8} {'req/s':>15} {'p50 ms':>15} {'p95 ms':>15} {'p99 ms':>15} {'errors':>7}")
+    for route, r in report["routes"].items():
+        cells = [f"{r[key]:.1f}{change(route, key, r[key])}" for key in ("rps", "p50_ms", "p95_ms", "p99_ms")]
+        print(f"{route:<18} {r['requests']:>8} {cells[0]:>15} {cells[1]:>15} {cells[2]:>15} {cells[3]:>15} "
+              f"{r['errors']:>7}")
+        if r["errors"]:
+            print(f"{'':<18} statuses: {r['statuses']}")
+    total = sum(r["requests"] for r in report["routes"].values())
+    print(f"\n{total} requests in {report['elapsed_seconds']:.1f}s ({total / report['elapsed_seconds']:.1f} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic mix and report per-route latency.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--users", type=int, default=1000, help="bench users seeded by seed.py")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests instead")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="action=weight,... (%(default)s)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--json", help="write the report here")
+    parser.add_argument("--baseline", help="report from an earlier run to compare against")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    deadline = time.monotonic() + (args.duration if not args.requests else 10 ** 9)
+    workers = [Worker(i, args, mix, deadline) for i in range(args.concurrency)]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    report = build_report(workers, time.monotonic() - started)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
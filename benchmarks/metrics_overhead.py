@@ -0,0 +1,48 @@
+"""Microbenchmark: per-request cost of the metrics instrumentation.
+
+    python benchmarks/metrics_overhead.py [--number N] [--queries Q]
+
+Times what instrument() adds to one request that runs Q statements and
+one bcrypt check: request_started(), Q record_query() calls, one
+record_bcrypt() and request_finished(). Flask's own hook dispatch and
+the url_rule lookup are not included; they add a few µs on top. The
+budget is 50µs per request.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metrics  # noqa: E402
+
+QUERY = "SELECT id, btc_balance, hashrate FROM users WHERE id = %s"
+
+
+def one_request(queries):
+    metrics.request_started("/user/overview")
+    for _ in range(queries):
+        metrics.record_query(0.0004, QUERY)
+    metrics.record_bcrypt(0.2, "checks")
+    metrics.request_finished("GET", 200)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=5)
+    args = parser.parse_args()
+
+    # Keep the slow request log quiet; the fake bcrypt time would trip it.
+    metrics.METRICS_SLOW_REQUEST = float("inf")
+
+    t = min(timeit.repeat(lambda: one_request(args.queries), number=args.number, repeat=5)) / args.number
+    print(f"{args.queries} queries + 1 bcrypt per request: {t * 1e6:.2f} µs/request (budget 50 µs)")
+    t = min(timeit.repeat(lambda: metrics.REQUESTS.observe(0.012, "/x", "GET", "200"),
+                          number=args.number, repeat=5)) / args.number
+    print(f"Histogram.observe: {t * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
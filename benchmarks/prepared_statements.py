@@ -0,0 +1,113 @@
+"""Benchmark: plain vs prepared statements on the mine-sync and dashboard paths.
+
+    python benchmarks/prepared_statements.py --users 100000 [--number 2000]
+
+Needs users from seed.py (same --users) in DATABASE_URL. Replays the
+statements /user/mine-sync (accrual, then projection) and /user/dashboard
+run, for random bench users, once as plain statements and once through
+execute_prepared(). Every request runs in its own transaction and is
+rolled back, so both passes see the same data. Reports the time per
+request in each mode, then the server-side planning time per statement
+from EXPLAIN (ANALYZE, SUMMARY), which is where the saving comes from.
+
+PostgreSQL plans the first five executions of a prepared statement with
+the actual parameters and switches to a cached generic plan only if it
+is not costlier, so run with --number well above 5 per connection.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import statements  # noqa: E402
+from benchmarks.fixtures import bench_email, is_suspended  # noqa: E402
+from db import get_db  # noqa: E402
+from mining import (  # noqa: E402
+    ACCRUE_USER_STATEMENT, MINE_SYNC_MIN_INTERVAL, MINING_FACTOR, PROJECT_USER_STATEMENT, USER_DASHBOARD_STATEMENT,
+)
+
+ROUTES = {
+    "/user/mine-sync": [ACCRUE_USER_STATEMENT["email"], PROJECT_USER_STATEMENT["email"]],
+    "/user/dashboard": [USER_DASHBOARD_STATEMENT["email"]],
+}
+PLANNING_TIME = re.compile(r"Planning Time: ([\d.]+) ms")
+
+
+def params_for(email):
+    now = datetime.utcnow()
+    return {"user": email, "now": now, "since": now - MINE_SYNC_MIN_INTERVAL, "factor": MINING_FACTOR}
+
+
+def run(conn, names, params, prepared):
+    cur = conn.cursor()
+    for name in names:
+        if prepared:
+            statements.execute_prepared(cur, name, params)
+        else:
+            cur.execute(statements.STATEMENTS[name].sql, params)
+        cur.fetchall()
+    conn.rollback()
+
+
+def planning_ms(conn, name, params, prepared):
+    statement = statements.STATEMENTS[name]
+    cur = conn.cursor()
+    if prepared:
+        values = [params[a] for a in statement.args]
+        cur.execute(f"EXPLAIN (ANALYZE, SUMMARY) EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+    else:
+        cur.execute("EXPLAIN (ANALYZE, SUMMARY) " + statement.sql, params)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    conn.rollback()
+    return float(PLANNING_TIME.search(plan).group(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="bench users seeded by seed.py")
+    parser.add_argument("--number", type=int, default=2000, help="requests per route and mode")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if not statements.PREPARED_STATEMENTS:
+        sys.exit("PREPARED_STATEMENTS=0: unset it to compare against prepared statements")
+
+    emails = []
+    rng = random.Random(args.seed)
+    while len(emails) < args.number:
+        n = rng.randrange(args.users)
+        if not is_suspended(n):
+            emails.append(bench_email(n))
+
+    with get_db() as conn:
+        print(f"{'route':<18} {'plain µs':>10} {'prepared µs':>12} {'change':>8}")
+        for route, names in ROUTES.items():
+            # Warm up both paths (and get the prepared one past its custom plans)
+            for email in emails[:20]:
+                run(conn, names, params_for(email), False)
+                run(conn, names, params_for(email), True)
+            timings = {}
+            for prepared in (False, True):
+                started = time.perf_counter()
+                for email in emails:
+                    run(conn, names, params_for(email), prepared)
+                timings[prepared] = (time.perf_counter() - started) / len(emails)
+            change = (timings[True] - timings[False]) / timings[False] * 100
+            print(f"{route:<18} {timings[False] * 1e6:>10.0f} {timings[True] * 1e6:>12.0f} {change:>+7.0f}%")
+
+        print(f"\n{'statement':<26} {'plan ms (plain)':>16} {'plan ms (prepared)':>19}")
+        samples = emails[:100]
+        for names in ROUTES.values():
+            for name in names:
+                plain = sum(planning_ms(conn, name, params_for(e), False) for e in samples) / len(samples)
+                prepared = sum(planning_ms(conn, name, params_for(e), True) for e in samples) / len(samples)
+                print(f"{name:<26} {plain:>16.3f} {prepared:>19.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Microbenchmark: old Decimal balance arithmetic vs integer satoshis.
+
+    python benchmarks/satoshi_arith.py [--number N]
+
+Times the per-request work mine-sync and withdraw used to do in Python
+(Decimal(str(...)) conversions, Decimal math, float(round(...)) for JSON)
+against the integer-satoshi path with its single sats_to_btc() boundary.
+The withdraw case still parses its input through Decimal once, and now
+also rejects sub-satoshi amounts, so it is not expected to get faster;
+the saving is on the per-sync accrual path.
+"""
+import argparse
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from money import btc_to_sats, sats_to_btc  # noqa: E402
+
+BALANCE_BTC = Decimal("0.12345678")
+BALANCE_SATS = 12345678
+HASHRATE = 350
+SECONDS = 93.412345
+
+
+def mine_sync_decimal():
+    seconds_elapsed = Decimal(str(SECONDS))
+    mined_btc = Decimal(str(HASHRATE)) * seconds_elapsed * Decimal("0.00000001")
+    new_balance = BALANCE_BTC + mined_btc
+    return float(round(mined_btc, 8)), float(round(new_balance, 8))
+
+
+def mine_sync_sats():
+    mined = int(HASHRATE * SECONDS)
+    new_balance = BALANCE_SATS + mined
+    return sats_to_btc(mined), sats_to_btc(new_balance)
+
+
+def withdraw_decimal():
+    amount = Decimal(str(0.0015))
+    new_balance = BALANCE_BTC - amount if amount <= BALANCE_BTC else BALANCE_BTC
+    return float(new_balance)
+
+
+def withdraw_sats():
+    amount = btc_to_sats(0.0015)
+    new_balance = BALANCE_SATS - amount if amount <= BALANCE_SATS else BALANCE_SATS
+    return sats_to_btc(new_balance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'case':<12} {'decimal ns/op':>14} {'sats ns/op':>12} {'speedup':>8}")
+    for name, old, new in (("mine-sync", mine_sync_decimal, mine_sync_sats),
+                           ("withdraw", withdraw_decimal, withdraw_sats)):
+        t_old = min(timeit.repeat(old, number=args.number, repeat=5)) / args.number * 1e9
+        t_new = min(timeit.repeat(new, number=args.number, repeat=5)) / args.number * 1e9
+        print(f"{name:<12} {t_old:>14.0f} {t_new:>12.0f} {t_old / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
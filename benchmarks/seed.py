@@ -0,0 +1,180 @@
+"""Seed DATABASE_URL with synthetic users, hashrate grants and withdrawals.
+
+    python benchmarks/seed.py --users 1000
+    python benchmarks/seed.py --users 1000000 --chunk-size 20000 --reset
+
+Bench users are bench-<n>@example.test for n in [0, users), all with
+password BENCH_PASSWORD and PIN BENCH_PIN, so loadtest.py can log in as
+any of them. Every user's grants and withdrawals come from a generator
+seeded with (--seed, n), so the same arguments produce the same data
+(timestamps are relative to the time of seeding). Every hundredth user
+is suspended. Rows are written with COPY, one transaction per chunk;
+ids are reserved from the sequences first so grants and withdrawals can
+reference their users without a round trip per row.
+
+Seeding adapts to the schema it finds, so the same data can be loaded
+into a database created by an older build when comparing before and
+after a change. Columns added later (users.hashrate, hashrates.active)
+are skipped when absent, and amounts are written as BTC where the
+columns are still NUMERIC rather than satoshi BIGINTs. Migrations only
+run on an empty database or with --migrate.
+
+Point the app at a throwaway database: --reset deletes all bench users.
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.fixtures import BENCH_EMAIL_LIKE, BENCH_PASSWORD, BENCH_PIN, bench_email, is_suspended  # noqa: E402
+from db import get_db  # noqa: E402
+from passwords import hash_password  # noqa: E402
+from schema import ensure_schema  # noqa: E402
+
+COUNTRIES = ["Nigeria", "Ghana", "Kenya", "India", "Brazil", "Germany", "United States", "Philippines"]
+GRANT_HASHRATE = 100
+
+
+def user_plan(n, seed, now, grants, withdrawals):
+    """Deterministic (user, grants, withdrawals) rows for bench user ``n``, without ids."""
+    rng = random.Random(f"{seed}:{n}")
+    user_grants = []
+    for _ in range(rng.randint(0, 2 * grants)):
+        created = now - timedelta(seconds=rng.uniform(0, 48 * 3600))
+        expires = created + timedelta(hours=24)
+        user_grants.append((GRANT_HASHRATE, created, expires, expires > now))
+    user_withdrawals = []
+    for _ in range(rng.randint(0, 2 * withdrawals)):
+        status = rng.choices(["pending", "approved", "rejected"], weights=[3, 6, 1])[0]
+        user_withdrawals.append((
+            rng.randint(10_000, 5_000_000),
+            f"bc1qbench{n:x}{rng.getrandbits(64):016x}",
+            status,
+            now - timedelta(seconds=rng.uniform(0, 30 * 86400)),
+        ))
+    balance = rng.randint(0, 20_000_000)
+    user = {
+        "full_name": f"Bench User {n}",
+        "email": bench_email(n),
+        "country": rng.choice(COUNTRIES),
+        "btc_balance": balance,
+        "total_earned": balance + sum(w[0] for w in user_withdrawals),
+        "last_mined": now - timedelta(seconds=rng.uniform(0, 3600)),
+        "suspended": is_suspended(n),
+        "hashrate": sum(g[0] for g in user_grants if g[3]),
+    }
+    return user, user_grants, user_withdrawals
+
+
+def table_columns(cur, table):
+    """{column: data_type} for ``table`` in the current schema; empty if it does not exist."""
+    cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, (table,))
+    return dict(cur.fetchall())
+
+
+def amount_writer(columns, name):
+    # Satoshi BIGINTs since the integer-amounts migration, NUMERIC BTC before it
+    if columns.get(name) in ("bigint", "integer"):
+        return lambda sats: sats
+    return lambda sats: Decimal(sats).scaleb(-8)
+
+
+def reserve_ids(cur, sequence, count):
+    if not count:
+        return []
+    cur.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", (sequence, count))
+    return [row[0] for row in cur.fetchall()]
+
+
+def copy_rows(cur, table, columns, rows, present):
+    # Drop the columns this schema does not have yet
+    keep = [i for i, c in enumerate(columns) if c in present]
+    columns = [columns[i] for i in keep]
+    buf = io.StringIO()
+    csv.writer(buf).writerows([row[i] for i in keep] for row in rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def seed_chunk(cur, lo, hi, args, now, password_hash, schema):
+    plans = [user_plan(n, args.seed, now, args.grants, args.withdrawals) for n in range(lo, hi)]
+    user_ids = reserve_ids(cur, "users", len(plans))
+    grant_ids = iter(reserve_ids(cur, "hashrates", sum(len(p[1]) for p in plans)))
+    withdrawal_ids = iter(reserve_ids(cur, "withdrawals", sum(len(p[2]) for p in plans)))
+
+    sats = amount_writer(schema["users"], "btc_balance")
+    withdrawal_sats = amount_writer(schema["withdrawals"], "amount")
+    users, grants, withdrawals = [], [], []
+    for user_id, (user, user_grants, user_withdrawals) in zip(user_ids, plans):
+        users.append((
+            user_id, user["full_name"], user["email"], user["country"], password_hash, BENCH_PIN,
+            sats(user["btc_balance"]), sats(user["total_earned"]), user["last_mined"], user["suspended"], user["hashrate"],
+        ))
+        for hashrate, created, expires, active in user_grants:
+            grants.append((next(grant_ids), user_id, hashrate, created, expires, active))
+        for amount, wallet, status, created in user_withdrawals:
+            withdrawals.append((next(withdrawal_ids), user_id, withdrawal_sats(amount), wallet, status, created))
+
+    copy_rows(cur, "users", ["id", "full_name", "email", "country", "password", "pin", "btc_balance",
+                             "total_earned", "last_mined", "suspended", "hashrate"], users, schema["users"])
+    copy_rows(cur, "hashrates", ["id", "user_id", "hashrate", "created_at", "expires_at", "active"], grants,
+              schema["hashrates"])
+    copy_rows(cur, "withdrawals", ["id", "user_id", "amount", "wallet", "status", "created_at"], withdrawals,
+              schema["withdrawals"])
+    return len(users), len(grants), len(withdrawals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic benchmark data.")
+    parser.add_argument("--users", type=int, default=1000, help="bench users to create (1k - 1M)")
+    parser.add_argument("--grants", type=int, default=3, help="mean hashrate grants per user")
+    parser.add_argument("--withdrawals", type=int, default=1, help="mean withdrawals per user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=10000, help="users per COPY transaction")
+    parser.add_argument("--reset", action="store_true", help="delete existing bench users first")
+    parser.add_argument("--migrate", action="store_true", help="bring the schema up to date first")
+    args = parser.parse_args()
+
+    with get_db() as conn:
+        fresh = not table_columns(conn.cursor(), "users")
+    if fresh or args.migrate:
+        ensure_schema()
+    password_hash = hash_password(BENCH_PASSWORD)
+    now = datetime.utcnow()
+    started = time.monotonic()
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        schema = {table: table_columns(cur, table) for table in ("users", "hashrates", "withdrawals")}
+        if args.reset:
+            cur.execute("DELETE FROM users WHERE email LIKE %s", (BENCH_EMAIL_LIKE,))
+            print(f"Deleted {cur.rowcount} bench users")
+            conn.commit()
+
+        totals = [0, 0, 0]
+        for lo in range(0, args.users, args.chunk_size):
+            hi = min(lo + args.chunk_size, args.users)
+            counts = seed_chunk(cur, lo, hi, args, now, password_hash, schema)
+            conn.commit()
+            totals = [t + c for t, c in zip(totals, counts)]
+            print(f"  {hi}/{args.users} users ({time.monotonic() - started:.1f}s)")
+
+        cur.execute("ANALYZE users; ANALYZE hashrates; ANALYZE withdrawals")
+        conn.commit()
+
+    print(f"Seeded {totals[0]} users, {totals[1]} grants, {totals[2]} withdrawals "
+          f"in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
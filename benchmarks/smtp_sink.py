@@ -0,0 +1,88 @@
+"""Fake SMTP server that accepts and discards every message.
+
+    python benchmarks/smtp_sink.py --port 2525
+
+Run the app against it so OTP mail costs what a fast relay would, without
+sending anything:
+
+    EMAIL_FROM=bench@example.test EMAIL_PASSWORD= SMTP_SERVER=127.0.0.1 SMTP_PORT=2525 SMTP_STARTTLS=0 \
+        gunicorn server:app
+
+Speaks just enough SMTP for smtplib (EHLO/HELO, MAIL, RCPT, DATA, RSET,
+NOOP, QUIT; no TLS or AUTH, hence the empty password and SMTP_STARTTLS=0) and
+prints a message count every --report seconds. --delay adds latency per
+message to mimic a remote relay.
+"""
+import argparse
+import asyncio
+import time
+
+_received = 0
+
+
+async def handle(reader, writer, delay):
+    global _received
+
+    def reply(line):
+        writer.write(f"{line}\r\n".encode())
+
+    reply("220 smtp-sink ESMTP ready")
+    try:
+        while True:
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                break
+            verb = line.decode("latin-1").strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                writer.write(b"250-smtp-sink\r\n250-8BITMIME\r\n250 SIZE 10485760\r\n")
+            elif verb == "DATA":
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                await writer.drain()
+                while (await reader.readline()) not in (b".\r\n", b".\n", b""):
+                    pass
+                if delay:
+                    await asyncio.sleep(delay)
+                _received += 1
+                reply("250 OK: queued")
+            elif verb == "QUIT":
+                reply("221 Bye")
+                await writer.drain()
+                break
+            elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                reply("250 OK")
+            else:
+                reply("502 Command not implemented")
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def report(interval):
+    last, last_at = 0, time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        print(f"{_received} messages ({(_received - last) / (now - last_at):.1f}/s)")
+        last, last_at = _received, now
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Accept and discard SMTP mail.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--delay", type=float, default=0, help="seconds to wait per message")
+    parser.add_argument("--report", type=float, default=10, help="seconds between counts (0 = quiet)")
+    args = parser.parse_args()
+
+    server = await asyncio.start_server(lambda r, w: handle(r, w, args.delay), args.host, args.port)
+    print(f"SMTP sink listening on {args.host}:{args.port}")
+    if args.report:
+        asyncio.create_task(report(args.report))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
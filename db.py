@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from metrics import DB_CONNECT, record_query
+from perprocess import per_process
+from profiler import PROFILER_ENABLED, ProfilingCursor
+from statements import PreparedConnection
+
+# === POOL CONFIG (per gunicorn worker) ===
+DATABASE_URL = os.getenv("DATABASE_URL")  # Make sure to set this env var in your deployment
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # seconds to wait for a free connection
+DB_POOL_MAX_AGE = float(os.getenv("DB_POOL_MAX_AGE", "1800"))        # recycle connections older than this
+DB_POOL_VALIDATE_IDLE = float(os.getenv("DB_POOL_VALIDATE_IDLE", "30"))  # ping connections idle longer than this
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class TimedCursor(extensions.cursor):
+    """Cursor that reports every statement's execution time to metrics."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(time.perf_counter() - started, query)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(time.perf_counter() - started, query)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_query(time.perf_counter() - started, sql)
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections owned by a single process."""
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 max_age=DB_POOL_MAX_AGE, validate_idle=DB_POOL_VALIDATE_IDLE, readonly=False):
+        self.dsn = dsn
+        self.readonly = readonly
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.validate_idle = validate_idle
+
+        self._cond = threading.Condition()
+        self._idle = []       # [(conn, last_used)], most recently used last
+        self._born = {}       # id(conn) -> creation time
+        self._size = 0        # open connections, idle + checked out
+        self._counters = {
+            "connects": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "failed_validations": 0,
+            "recycled": 0,
+            "discarded": 0,
+        }
+
+        for _ in range(minconn):
+            conn = self._connect()
+            self._idle.append((conn, time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        started = time.perf_counter()
+        conn = psycopg2.connect(
+            self.dsn,
+            connection_factory=PreparedConnection,
+            cursor_factory=ProfilingCursor if PROFILER_ENABLED else TimedCursor,
+        )
+        DB_CONNECT.observe(time.perf_counter() - started)
+        if self.readonly:
+            # A replica DSN that is really a writable server fails loudly instead of diverging
+            conn.set_session(readonly=True)
+        with self._cond:
+            self._born[id(conn)] = time.monotonic()
+            self._counters["connects"] += 1
+        return conn
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn, now):
+        return now - self._born.get(id(conn), now) > self.max_age
+
+    def _usable(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self.validate_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout("No database connection available")
+                    self._counters["waits"] += 1
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                break
+
+            now = time.monotonic()
+            if self._expired(conn, now):
+                self._discard(conn, "recycled")
+                continue
+            if not self._usable(conn, last_used, now):
+                self._discard(conn, "failed_validations")
+                continue
+            break
+
+        with self._cond:
+            self._counters["checkouts"] += 1
+        return conn
+
+    def _discard(self, conn, counter):
+        self._close(conn)
+        with self._cond:
+            self._counters[counter] += 1
+            self._size -= 1
+            self._cond.notify()
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        if discard or conn.closed:
+            self._discard(conn, "discarded")
+            return
+        if self._expired(conn, time.monotonic()):
+            self._discard(conn, "recycled")
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+            })
+        return stats
+
+
+# Pools are per process: a gunicorn worker forked from the master must
+# never reuse sockets opened before the fork.
+_pools = per_process(dict)      # dsn -> ConnectionPool
+_pool_lock = threading.Lock()
+
+
+def get_pool(dsn=None, readonly=False):
+    dsn = dsn or DATABASE_URL
+    pools = _pools()
+    if dsn not in pools:
+        with _pool_lock:
+            if dsn not in pools:
+                pools[dsn] = ConnectionPool(dsn, readonly=readonly)
+    return pools[dsn]
+
+
+@contextmanager
+def lease(pool, conn):
+    """Hand ``conn`` back to ``pool`` afterwards, discarding it if the connection broke."""
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+
+def get_db(dsn=None):
+    # Checks out at call time, so a PoolTimeout surfaces at the with statement
+    pool = get_pool(dsn)
+    return lease(pool, pool.getconn())
+
+
+def pool_stats():
+    return get_pool().stats()
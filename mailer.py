@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+
+from metrics import SMTP_SEND
+from perprocess import per_process
+
+# === MAIL CONFIG ===
+# Credentials come from the environment only. An empty EMAIL_PASSWORD skips
+# AUTH (e.g. for benchmarks/smtp_sink.py), but it must be set explicitly.
+EMAIL_FROM = os.getenv("EMAIL_FROM")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+if not EMAIL_FROM or EMAIL_PASSWORD is None:
+    raise RuntimeError("EMAIL_FROM and EMAIL_PASSWORD must be set.")
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"      # disable for a local fake SMTP server
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "10"))
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "1000"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "50"))
+MAIL_MAX_RETRIES = int(os.getenv("MAIL_MAX_RETRIES", "5"))
+MAIL_RETRY_BACKOFF = float(os.getenv("MAIL_RETRY_BACKOFF", "1"))     # seconds, doubled per attempt of a message
+MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", "60"))      # close the SMTP session after this long idle
+MAIL_NOOP_AFTER = float(os.getenv("MAIL_NOOP_AFTER", "5"))          # check a session idle this long with NOOP first
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailDispatcher:
+    """Sends queued messages from a background thread over one reused SMTP session."""
+
+    def __init__(self, host=SMTP_SERVER, port=SMTP_PORT, username=EMAIL_FROM, password=EMAIL_PASSWORD,
+                 starttls=SMTP_STARTTLS, maxsize=MAIL_QUEUE_SIZE, batch_size=MAIL_BATCH_SIZE,
+                 max_retries=MAIL_MAX_RETRIES, backoff=MAIL_RETRY_BACKOFF, idle_timeout=MAIL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._delayed = []      # heap of (due, seq, msg, attempts) waiting to be retried
+        self._seq = itertools.count()
+        self._smtp = None
+        self._used_at = 0.0     # monotonic time of the last command on self._smtp
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, msg):
+        try:
+            self._queue.put_nowait((msg, 0))
+        except queue.Full:
+            raise MailQueueFull("Mail queue is full")
+
+    def pending(self):
+        return self._queue.qsize() + len(self._delayed)
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        self._queue.put((None, 0))
+        self._thread.join(timeout)
+
+    # --- SMTP session ---
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.starttls:
+            smtp.starttls()
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        return smtp
+
+    def _session(self):
+        # A session in use moments ago is trusted; a send on a dead one fails
+        # and is retried. Only one that has sat idle is checked first.
+        if self._smtp is not None and time.monotonic() - self._used_at < MAIL_NOOP_AFTER:
+            return self._smtp
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    self._used_at = time.monotonic()
+                    return self._smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._close()
+        self._smtp = self._open()
+        self._used_at = time.monotonic()
+        return self._smtp
+
+    def _close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
+
+    # --- worker loop ---
+
+    def _due(self):
+        now = time.monotonic()
+        batch = []
+        while self._delayed and self._delayed[0][0] <= now and len(batch) < self.batch_size:
+            _, _, msg, attempts = heapq.heappop(self._delayed)
+            batch.append((msg, attempts))
+        return batch
+
+    def _next_batch(self):
+        batch = self._due()
+        if not batch:
+            timeout = self.idle_timeout
+            if self._delayed:
+                timeout = max(0, min(timeout, self._delayed[0][0] - time.monotonic()))
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                if not self._delayed:
+                    self._close()
+                return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send_batch(self, batch):
+        """Send each message; returns the (msg, attempts) pairs to retry."""
+        retry = []
+        for i, (msg, attempts) in enumerate(batch):
+            started = time.perf_counter()
+            try:
+                smtp = self._session()
+            except (smtplib.SMTPException, OSError) as e:
+                SMTP_SEND.observe(time.perf_counter() - started, "error")
+                print("Mail connection error:", e)
+                self._close()
+                # No session: nothing left in the batch can be sent now.
+                return retry + [(m, a + 1) for m, a in batch[i:]]
+            try:
+                smtp.send_message(msg)
+                self._used_at = time.monotonic()
+                SMTP_SEND.observe(time.perf_counter() - started, "ok")
+            except smtplib.SMTPRecipientsRefused as e:
+                self._used_at = time.monotonic()
+                SMTP_SEND.observe(time.perf_counter() - started, "error")
+                print("Mail rejected:", msg["To"], e.recipients)
+            except smtplib.SMTPResponseException as e:
+                # The server answered, so the session is fine; only this message failed.
+                self._used_at = time.monotonic()
+                SMTP_SEND.observe(time.perf_counter() - started, "error")
+                if e.smtp_code >= 500:
+                    print("Mail rejected:", msg["To"], e.smtp_code, e.smtp_error)
+                else:
+                    retry.append((msg, attempts + 1))
+            except (smtplib.SMTPException, OSError) as e:
+                SMTP_SEND.observe(time.perf_counter() - started, "error")
+                print("Mail send error:", e)
+                self._close()
+                retry.append((msg, attempts + 1))
+        return retry
+
+    def _schedule(self, retry):
+        # Each message waits out its own backoff; the rest of the queue keeps flowing.
+        now = time.monotonic()
+        for msg, attempts in retry:
+            if attempts > self.max_retries:
+                print("Mail dropped after retries:", msg["To"])
+                continue
+            due = now + self.backoff * (2 ** (attempts - 1))
+            heapq.heappush(self._delayed, (due, next(self._seq), msg, attempts))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if any(msg is None for msg, _ in batch):
+                batch = [item for item in batch if item[0] is not None]
+                self._send_batch(batch)
+                self._close()
+                return
+            self._schedule(self._send_batch(batch))
+
+
+@per_process
+def get_dispatcher():
+    # One dispatcher thread per worker process, started on first use.
+    return MailDispatcher()
+
+
+def send_mail(to, subject, body):
+    msg = MIMEText(body)
+    msg['Subject'] = subject
+    msg['From'] = EMAIL_FROM
+    msg['To'] = to
+    get_dispatcher().enqueue(msg)
@@ -0,0 +1,239 @@
+"""Latency histograms, Prometheus exposition and the slow request log.
+
+instrument(app) times every request per route (the URL rule, so labels
+stay bounded). The DB pool, the mail dispatcher and the bcrypt pool feed
+their own histograms, and query time is also added up per request, so a
+slow request log line says how much of it was spent in PostgreSQL and
+bcrypt. Lines are JSON, one per request over METRICS_SLOW_REQUEST seconds
+(and per statement over METRICS_SLOW_QUERY).
+
+Histograms live in each worker's memory. With METRICS_DIR set, every
+worker also snapshots them to METRICS_DIR/metrics-<pid>.json every few
+seconds and /metrics sums all snapshots, so one scrape covers the whole
+gunicorn. Empty the directory when the service is (re)deployed.
+
+Recording is a bisect and a few additions under a lock; the request hooks
+stay well under 50µs (see benchmarks/metrics_overhead.py).
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from perprocess import per_process
+
+METRICS_SLOW_REQUEST = float(os.getenv("METRICS_SLOW_REQUEST", "1.0"))
+METRICS_SLOW_QUERY = float(os.getenv("METRICS_SLOW_QUERY", "0.5"))
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}   # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: list(series) for labels, series in self._series.items()}
+
+
+REGISTRY = [
+    Histogram("http_request_duration_seconds", "Request latency by route.", ("route", "method", "status")),
+    Histogram("db_connect_duration_seconds", "Time to open a new PostgreSQL connection."),
+    Histogram("db_query_duration_seconds", "Statement execution time by route.", ("route",)),
+    Histogram("smtp_send_duration_seconds", "Time to hand one message to the SMTP server.", ("result",)),
+    Histogram("bcrypt_duration_seconds", "bcrypt hash/check time, excluding queueing.", ("kind",)),
+]
+_by_name = {h.name: h for h in REGISTRY}
+REQUESTS = _by_name["http_request_duration_seconds"]
+DB_CONNECT = _by_name["db_connect_duration_seconds"]
+DB_QUERY = _by_name["db_query_duration_seconds"]
+SMTP_SEND = _by_name["smtp_send_duration_seconds"]
+BCRYPT = _by_name["bcrypt_duration_seconds"]
+
+
+# === PER-REQUEST ACCOUNTING ===
+
+_request = threading.local()
+
+
+def current_route():
+    return getattr(_request, "route", "-")
+
+
+def request_started(route):
+    _request.route = route
+    _request.started = time.perf_counter()
+    _request.db_seconds = 0.0
+    _request.db_queries = 0
+    _request.bcrypt_seconds = 0.0
+
+
+def request_finished(method, status):
+    """Record the request; returns its duration in seconds."""
+    started = getattr(_request, "started", None)
+    if started is None:
+        return None
+    duration = time.perf_counter() - started
+    _request.started = None
+    route = _request.route
+    REQUESTS.observe(duration, route, method, str(status))
+    if duration >= METRICS_SLOW_REQUEST:
+        print(json.dumps({
+            "event": "slow_request",
+            "route": route,
+            "method": method,
+            "status": status,
+            "ms": round(duration * 1000, 1),
+            "db_ms": round(_request.db_seconds * 1000, 1),
+            "db_queries": _request.db_queries,
+            "bcrypt_ms": round(_request.bcrypt_seconds * 1000, 1),
+        }))
+    _request.route = "-"
+    return duration
+
+
+def record_query(seconds, query):
+    route = current_route()
+    DB_QUERY.observe(seconds, route)
+    if getattr(_request, "started", None) is not None:
+        _request.db_seconds += seconds
+        _request.db_queries += 1
+    if seconds >= METRICS_SLOW_QUERY:
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        print(json.dumps({
+            "event": "slow_query",
+            "route": route,
+            "ms": round(seconds * 1000, 1),
+            "query": " ".join(str(query).split())[:300],
+        }))
+
+
+def record_bcrypt(seconds, kind):
+    # Called from the request thread once the hash is back from the pool.
+    BCRYPT.observe(seconds, kind)
+    if getattr(_request, "started", None) is not None:
+        _request.bcrypt_seconds += seconds
+
+
+def instrument(app):
+    from flask import request
+
+    @app.before_request
+    def _start_timer():
+        if METRICS_DIR:
+            _ensure_snapshots()
+        rule = request.url_rule
+        request_started(rule.rule if rule is not None else "unmatched")
+
+    @app.after_request
+    def _stop_timer(response):
+        request_finished(request.method, response.status_code)
+        return response
+
+
+# === EXPOSITION ===
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _merged():
+    snapshots = {h.name: h.snapshot() for h in REGISTRY}
+    if not METRICS_DIR:
+        return snapshots
+    own = _snapshot_path()
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue  # being replaced right now, or gone
+        for name, series in other.items():
+            if name not in snapshots:
+                continue
+            merged = snapshots[name]
+            for labels, values in series:
+                labels = tuple(labels)
+                if labels in merged:
+                    merged[labels] = [a + b for a, b in zip(merged[labels], values)]
+                else:
+                    merged[labels] = values
+    return snapshots
+
+
+def render():
+    """All histograms in the Prometheus text format (version 0.0.4)."""
+    snapshots = _merged()
+    lines = []
+    for h in REGISTRY:
+        lines.append(f"# HELP {h.name} {h.help}")
+        lines.append(f"# TYPE {h.name} histogram")
+        for labels, series in sorted(snapshots[h.name].items()):
+            cumulative = 0
+            for bound, count in zip(h.buckets + ("+Inf",), series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{h.name}_bucket{_labels(h.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{h.name}_sum{_labels(h.labelnames, labels)} {series[-1]}")
+            lines.append(f"{h.name}_count{_labels(h.labelnames, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# === CROSS-WORKER SNAPSHOTS ===
+
+def _snapshot_path():
+    return os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+
+
+def write_snapshot():
+    data = {h.name: [[list(labels), series] for labels, series in h.snapshot().items()] for h in REGISTRY}
+    path = _snapshot_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _snapshot_forever():
+    while True:
+        time.sleep(METRICS_SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print("Metrics snapshot error:", e)
+
+
+@per_process
+def _ensure_snapshots():
+    # Started from the first request so each forked worker gets its own thread.
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=_snapshot_forever, name="metrics-snapshot", daemon=True).start()
@@ -0,0 +1,247 @@
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from statements import declare, execute_prepared
+
+# Mining formula: satoshis = hashrate * seconds * factor (1 sat = 0.00000001 BTC)
+MINING_FACTOR = 1
+
+# mine-sync only writes when the user has not been settled this recently;
+# in between it answers with a read-only projection. The settlement job
+# (settle.py) keeps everyone else current.
+MINE_SYNC_MIN_INTERVAL = timedelta(seconds=float(os.getenv("MINE_SYNC_MIN_INTERVAL", "30")))
+
+# Satoshis a user has mined between their last_mined and %(now)s. Each grant
+# only contributes the part of its [created_at, expires_at) window that
+# overlaps (last_mined, now]; grants that expired before last_mined are
+# skipped by the join, so the work is proportional to the user's live
+# grants. Fractions of a satoshi are dropped at each settlement.
+_ACCRUAL_COLUMNS = """
+        FLOOR(COALESCE(SUM(
+            h.hashrate * EXTRACT(EPOCH FROM GREATEST(
+                LEAST(h.expires_at, %(now)s) - GREATEST(h.created_at, l.last_mined),
+                INTERVAL '0'
+            ))
+        ), 0) * %(factor)s)::BIGINT AS mined,
+        COALESCE(SUM(h.hashrate) FILTER (WHERE h.expires_at > %(now)s), 0) AS hashrate
+"""
+
+_ACCRUAL_JOIN = """
+    LEFT JOIN hashrates h
+        ON h.user_id = l.id
+        AND h.expires_at > l.last_mined
+        AND h.created_at < %(now)s
+"""
+
+# What accrue_user() did for one user; ``settled`` is False when it only
+# projected, which is all it does for a suspended account.
+Accrual = namedtuple("Accrual", "mined balance hashrate user_id settled suspended")
+
+# The target users are locked first so concurrent settlements serialise on
+# the row, then balance, total_earned and last_mined move in one UPDATE.
+_SETTLE_SQL = """
+WITH locked AS (
+    SELECT id, last_mined
+    FROM users u
+    WHERE {where}
+    ORDER BY id
+    FOR UPDATE
+),
+accrued AS (
+    SELECT
+        l.id,
+""" + _ACCRUAL_COLUMNS + """
+    FROM locked l
+""" + _ACCRUAL_JOIN + """
+    GROUP BY l.id
+)
+UPDATE users u
+SET btc_balance = u.btc_balance + a.mined,
+    total_earned = u.total_earned + a.mined,
+    last_mined = GREATEST(u.last_mined, %(now)s)
+FROM accrued a
+WHERE u.id = a.id
+RETURNING a.mined, u.btc_balance, a.hashrate, u.id
+"""
+
+# Keyed by the column that identifies the user: "id" for session-token
+# callers, "email" for clients that only send their email.
+ACCRUE_USER_SQL = {
+    column: _SETTLE_SQL.format(where=f"{column} = %(user)s AND last_mined <= %(since)s AND NOT suspended")
+    for column in ("id", "email")
+}
+
+ACCRUE_RANGE_SQL = _SETTLE_SQL.format(
+    where="""id >= %(lo)s AND id < %(hi)s
+      AND EXISTS (
+          SELECT 1 FROM hashrates h
+          WHERE h.user_id = u.id AND h.expires_at > u.last_mined
+      )"""
+)
+
+_PROJECT_SQL = """
+SELECT
+""" + _ACCRUAL_COLUMNS + """,
+    l.btc_balance,
+    l.id,
+    l.suspended
+FROM users l
+""" + _ACCRUAL_JOIN + """
+WHERE l.{column} = %(user)s
+GROUP BY l.id
+"""
+
+PROJECT_USER_SQL = {column: _PROJECT_SQL.format(column=column) for column in ("id", "email")}
+
+# mine-sync runs one or both of these on every call; keep them prepared.
+_ACCRUAL_TYPES = {"now": "timestamp", "since": "timestamp", "factor": "numeric"}
+ACCRUE_USER_STATEMENT = {
+    column: declare(f"accrue_user_by_{column}", sql, _ACCRUAL_TYPES) for column, sql in ACCRUE_USER_SQL.items()
+}
+PROJECT_USER_STATEMENT = {
+    column: declare(f"project_user_by_{column}", sql, _ACCRUAL_TYPES) for column, sql in PROJECT_USER_SQL.items()
+}
+
+# Bulk projection for the live balance stream: where each user stands at
+# %(now)s and when their hashrate next drops.
+PROJECT_USERS_SQL = """
+SELECT
+    l.id,
+""" + _ACCRUAL_COLUMNS + """,
+    l.btc_balance,
+    MIN(h.expires_at) FILTER (WHERE h.expires_at > %(now)s) AS next_expiry
+FROM users l
+""" + _ACCRUAL_JOIN + """
+WHERE l.id = ANY(%(ids)s)
+GROUP BY l.id
+"""
+
+
+def accrue_user(cur, column, user, now=None, min_interval=MINE_SYNC_MIN_INTERVAL):
+    """Settle mining rewards up to ``now`` for the user whose ``column`` ("id" or "email") is ``user``.
+
+    Users settled less than ``min_interval`` ago, and suspended users, are
+    not written to; their unsettled earnings are projected instead. Returns
+    an Accrual, or ``None`` if the user does not exist. The caller owns the
+    transaction.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    params = {"user": user, "now": now, "since": now - min_interval, "factor": MINING_FACTOR}
+    execute_prepared(cur, ACCRUE_USER_STATEMENT[column], params)
+    row = cur.fetchone()
+    if row:
+        mined, balance, hashrate, user_id = row
+        return Accrual(mined, balance, hashrate, user_id, True, False)
+
+    execute_prepared(cur, PROJECT_USER_STATEMENT[column], params)
+    row = cur.fetchone()
+    if not row:
+        return None
+    mined, hashrate, balance, user_id, suspended = row
+    return Accrual(mined, balance + mined, hashrate, user_id, False, suspended)
+
+
+def accrue_range(cur, lo, hi, now):
+    """Settle every user with id in ``[lo, hi)`` that has grants to accrue.
+
+    Returns ``(users_settled, total_mined_sats)``. The caller owns the transaction.
+    """
+    cur.execute(ACCRUE_RANGE_SQL, {"lo": lo, "hi": hi, "now": now, "factor": MINING_FACTOR})
+    rows = cur.fetchall()
+    return len(rows), sum(r[0] for r in rows)
+
+
+# users.hashrate is maintained incrementally: claims add to it and
+# retire_expired_hashrates() subtracts grants once they expire. Until the
+# next retirement pass, readers subtract the few grants that have expired
+# but are still marked active (a tiny index range on hashrates_user_expires_idx).
+ACTIVE_HASHRATE_SQL = """
+    u.hashrate - COALESCE((
+        SELECT SUM(x.hashrate) FROM hashrates x
+        WHERE x.user_id = u.id AND x.active AND x.expires_at <= %(now)s
+    ), 0)
+"""
+
+# The /user/dashboard read, keyed like ACCRUE_USER_SQL.
+USER_DASHBOARD_STATEMENT = {
+    column: declare(f"user_dashboard_by_{column}", """
+        SELECT btc_balance, total_earned, last_mined, """ + ACTIVE_HASHRATE_SQL + """
+        FROM users u
+        WHERE u.""" + column + """ = %(user)s
+    """, {"now": "timestamp"})
+    for column in ("id", "email")
+}
+
+RETIRE_EXPIRED_SQL = """
+WITH expired AS (
+    UPDATE hashrates
+    SET active = FALSE
+    WHERE id IN (
+        SELECT id FROM hashrates
+        WHERE active AND expires_at <= %(now)s
+        ORDER BY expires_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING user_id, hashrate
+),
+totals AS (
+    UPDATE users u
+    SET hashrate = u.hashrate - e.total
+    FROM (SELECT user_id, SUM(hashrate) AS total FROM expired GROUP BY user_id) e
+    WHERE u.id = e.user_id
+    RETURNING u.id
+)
+SELECT (SELECT COUNT(*) FROM expired), (SELECT COUNT(*) FROM totals)
+"""
+
+# One statement for a claim; suspended accounts get neither the grant nor the total.
+GRANT_HASHRATE_SQL = """
+WITH target AS (
+    SELECT id, suspended FROM users WHERE id = %(user_id)s
+),
+granted AS (
+    INSERT INTO hashrates (user_id, hashrate, created_at, expires_at)
+    SELECT id, %(hashrate)s, %(now)s, %(expires_at)s FROM target WHERE NOT suspended
+    RETURNING user_id
+),
+total AS (
+    UPDATE users SET hashrate = hashrate + %(hashrate)s
+    WHERE id IN (SELECT user_id FROM granted)
+    RETURNING id
+)
+SELECT suspended FROM target
+"""
+
+
+def grant_hashrate(cur, user_id, hashrate, now, expires_at):
+    """Grant ``hashrate`` until ``expires_at`` and add it to the user's active total.
+
+    Returns True if granted, False if the account is suspended (nothing is
+    written) and None if the user does not exist.
+    """
+    cur.execute(GRANT_HASHRATE_SQL, {
+        "user_id": user_id, "hashrate": hashrate, "now": now, "expires_at": expires_at,
+    })
+    row = cur.fetchone()
+    return None if row is None else not row[0]
+
+
+def retire_expired_hashrates(cur, now, limit=1000):
+    """Mark up to ``limit`` expired grants inactive and take them off users.hashrate.
+
+    Returns the number of grants retired. The caller owns the transaction.
+    """
+    cur.execute(RETIRE_EXPIRED_SQL, {"now": now, "limit": limit})
+    return cur.fetchone()[0]
+
+
+def project_users(cur, user_ids, now):
+    """Return ``{user_id: (balance_sats_at_now, hashrate, next_expiry)}`` without writing anything."""
+    cur.execute(PROJECT_USERS_SQL, {"ids": list(user_ids), "now": now, "factor": MINING_FACTOR})
+    return {
+        user_id: (balance + mined, hashrate, next_expiry)
+        for user_id, mined, hashrate, balance, next_expiry in cur.fetchall()
+    }
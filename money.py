@@ -0,0 +1,29 @@
+"""BTC amounts are integer satoshis everywhere except at the JSON boundary."""
+from decimal import Decimal, InvalidOperation
+
+SATS_PER_BTC = 100_000_000
+MAX_BTC = 21_000_000    # every bitcoin there will ever be; anything larger is not an amount
+
+
+def btc_to_sats(value):
+    """Parse a BTC amount from a request (number or string) into satoshis.
+
+    Raises ValueError for anything that is not a whole number of satoshis
+    or is more than MAX_BTC either way.
+    """
+    try:
+        btc = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"Invalid BTC amount: {value!r}")
+    if not btc.is_finite() or abs(btc) > MAX_BTC:
+        raise ValueError(f"BTC amount out of range: {value!r}")
+    sats = btc * SATS_PER_BTC
+    if sats != sats.to_integral_value():
+        raise ValueError(f"BTC amount has more than 8 decimals: {value!r}")
+    return int(sats)
+
+
+def sats_to_btc(sats):
+    # The one place satoshis become BTC. Integer / 1e8 is correctly rounded,
+    # and json prints the shortest repr, so e.g. 12345 -> 0.00012345 exactly.
+    return sats / SATS_PER_BTC
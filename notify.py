@@ -0,0 +1,155 @@
+"""Cross-worker cache invalidation over PostgreSQL LISTEN/NOTIFY.
+
+Each worker process runs one listener thread on a dedicated (unpooled)
+connection and dispatches notifications to the callbacks registered with
+subscribe(). If the listener loses its connection, every callback is
+called with ``None`` after reconnecting, since notifications sent while
+it was down are gone.
+
+subscribe() returns once the listener has issued LISTEN for the channel
+(or after NOTIFY_SUBSCRIBE_TIMEOUT if it cannot), so anything loaded
+after subscribing is covered by later notifications. CachedValue builds
+the per-worker caches on top of that.
+"""
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from db import DATABASE_URL
+from perprocess import per_process
+
+NOTIFY_POLL_INTERVAL = 1.0
+NOTIFY_RECONNECT_DELAY = 5.0
+NOTIFY_SUBSCRIBE_TIMEOUT = 2.0
+
+_handlers = {}          # channel -> [callback(payload)]
+_listening = set()      # channels LISTENed on the current connection
+_lock = threading.Lock()
+_listened = threading.Condition(_lock)
+
+
+def publish(cur, channel, payload=""):
+    # Delivered when the caller's transaction commits, and not at all on rollback.
+    cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+
+@per_process
+def _listener():
+    # This process's listener thread, and the pipe that wakes it to LISTEN on new channels
+    _listening.clear()
+    wakeup = os.pipe()
+    threading.Thread(target=_listen_forever, args=(wakeup[0],), name="pg-notify", daemon=True).start()
+    return wakeup
+
+
+def subscribe(channel, callback):
+    with _lock:
+        callbacks = _handlers.setdefault(channel, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+        wakeup = _listener()
+        if channel not in _listening:
+            os.write(wakeup[1], b"x")
+            _listened.wait_for(lambda: channel in _listening, NOTIFY_SUBSCRIBE_TIMEOUT)
+
+
+def _dispatch(channel, payload):
+    for callback in list(_handlers.get(channel, ())):
+        try:
+            callback(payload)
+        except Exception as e:
+            print("Notify handler error:", e)
+
+
+def _listen(conn, wakeup):
+    cur = conn.cursor()
+    while True:
+        with _lock:
+            new = [c for c in _handlers if c not in _listening]
+        for channel in new:
+            cur.execute(f'LISTEN "{channel}"')
+            with _lock:
+                _listening.add(channel)
+                _listened.notify_all()
+
+        ready, _, _ = select.select([conn, wakeup], [], [], NOTIFY_POLL_INTERVAL)
+        if wakeup in ready:
+            os.read(wakeup, 512)
+        if conn not in ready:
+            continue
+        conn.poll()
+        while conn.notifies:
+            n = conn.notifies.pop(0)
+            _dispatch(n.channel, n.payload)
+
+
+def _listen_forever(wakeup):
+    first = True
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            _listening.clear()
+            if not first:
+                for channel in list(_handlers):
+                    _dispatch(channel, None)
+            first = False
+            _listen(conn, wakeup)
+        except Exception as e:
+            print("Notify listener error:", e)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(NOTIFY_RECONNECT_DELAY)
+
+
+class CachedValue:
+    """Per-worker cache of ``loader()``, dropped after ``ttl`` seconds or on a notification on ``channel``.
+
+    Invalidations bump a generation counter. A load only counts as fresh
+    if the generation did not move while it ran, so a notification that
+    races a reload makes the next read reload again instead of being lost.
+    """
+
+    def __init__(self, channel, loader, ttl):
+        self.channel = channel
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._loaded_at = None
+        self._generation = 0
+        self._loaded_generation = None
+        self._load_lock = threading.Lock()
+        self._generation_lock = threading.Lock()
+        self._subscribe = per_process(lambda: subscribe(self.channel, self.invalidate))
+
+    def invalidate(self, payload=None):
+        with self._generation_lock:
+            self._generation += 1
+
+    def _fresh(self):
+        return (
+            self._loaded_generation == self._generation
+            and time.monotonic() - self._loaded_at <= self.ttl
+        )
+
+    def get(self):
+        if not self._fresh():
+            with self._load_lock:
+                self._subscribe()
+                if not self._fresh():
+                    with self._generation_lock:
+                        generation = self._generation
+                    value = self.loader()
+                    self._value = value
+                    self._loaded_at = time.monotonic()
+                    self._loaded_generation = generation
+        return self._value
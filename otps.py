@@ -0,0 +1,138 @@
+"""One-time codes for signup and password/PIN resets.
+
+There is at most one live code per (email, purpose): issuing a new one
+replaces the old and resets its attempt counter. Expiry and the attempt
+limit are part of the lookup itself, so an expired or exhausted code is
+indistinguishable from a missing one, and a correct code is consumed by
+the same statement that checks it. A per-worker background thread deletes
+dead rows so the table stays small.
+"""
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import get_db
+from perprocess import per_process
+
+# purpose -> lifetime in seconds
+OTP_PURPOSES = {
+    "signup": 600,
+    "reset_password": 600,
+    "reset_pin": 600,
+    "admin_signup": 300,
+    "admin_reset": 600,
+}
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
+OTP_PURGE_INTERVAL = float(os.getenv("OTP_PURGE_INTERVAL", "300"))
+OTP_PURGE_BATCH = 5000
+
+ISSUE_SQL = """
+INSERT INTO otps (email, purpose, code, created_at, expires_at, attempts)
+VALUES (%(email)s, %(purpose)s, %(code)s, %(now)s, %(expires_at)s, 0)
+ON CONFLICT (email, purpose) DO UPDATE
+SET code = EXCLUDED.code, created_at = EXCLUDED.created_at,
+    expires_at = EXCLUDED.expires_at, attempts = 0
+"""
+
+# Point lookup on (email, purpose). A match deletes the code, a miss
+# spends an attempt. No row at all means missing, expired or exhausted.
+CHECK_SQL = """
+WITH o AS (
+    SELECT id, code = %(code)s AS ok
+    FROM otps
+    WHERE email = %(email)s AND purpose = %(purpose)s
+      AND expires_at > %(now)s AND attempts < %(max_attempts)s
+    FOR UPDATE
+),
+used AS (
+    DELETE FROM otps USING o WHERE otps.id = o.id AND o.ok
+    RETURNING otps.id
+),
+missed AS (
+    UPDATE otps SET attempts = otps.attempts + 1
+    FROM o WHERE otps.id = o.id AND NOT o.ok
+    RETURNING otps.id
+)
+SELECT ok FROM o
+"""
+
+PURGE_SQL = """
+DELETE FROM otps
+WHERE id IN (
+    SELECT id FROM otps
+    WHERE expires_at <= %s OR attempts >= %s
+    LIMIT %s
+)
+"""
+
+
+def generate_code():
+    return f"{secrets.randbelow(1000000):06d}"
+
+
+def issue_code(cur, email, purpose):
+    """Store a fresh code for ``email`` and return it; commit before sending it."""
+    _ensure_purger()
+    now = datetime.utcnow()
+    code = generate_code()
+    cur.execute(ISSUE_SQL, {
+        "email": email,
+        "purpose": purpose,
+        "code": code,
+        "now": now,
+        "expires_at": now + timedelta(seconds=OTP_PURPOSES[purpose])
+    })
+    return code
+
+
+def check_code(cur, email, purpose, code):
+    """Returns "verified" (and consumes the code), "invalid", or "expired"."""
+    if purpose not in OTP_PURPOSES:
+        raise ValueError(f"Unknown OTP purpose: {purpose}")
+    cur.execute(CHECK_SQL, {
+        "email": email,
+        "purpose": purpose,
+        "code": str(code or ""),
+        "now": datetime.utcnow(),
+        "max_attempts": OTP_MAX_ATTEMPTS
+    })
+    row = cur.fetchone()
+    if row is None:
+        return "expired"
+    return "verified" if row[0] else "invalid"
+
+
+def discard_code(cur, email, purpose):
+    cur.execute("DELETE FROM otps WHERE email = %s AND purpose = %s", (email, purpose))
+
+
+def purge_expired():
+    """Delete expired and exhausted codes in batches; returns how many."""
+    total = 0
+    while True:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute(PURGE_SQL, (datetime.utcnow(), OTP_MAX_ATTEMPTS, OTP_PURGE_BATCH))
+            deleted = cur.rowcount
+            conn.commit()
+        total += deleted
+        if deleted < OTP_PURGE_BATCH:
+            return total
+
+
+def _purge_forever():
+    while True:
+        time.sleep(OTP_PURGE_INTERVAL)
+        try:
+            purge_expired()
+        except Exception as e:
+            print("OTP purge error:", e)
+
+
+@per_process
+def _ensure_purger():
+    purger = threading.Thread(target=_purge_forever, name="otp-purge", daemon=True)
+    purger.start()
+    return purger
@@ -0,0 +1,102 @@
+"""bcrypt hashing on a bounded per-worker thread pool.
+
+bcrypt releases the GIL, so running it on a small pool keeps the request
+threads responsive while capping how many hashes a worker runs at once.
+When every worker thread is busy and HASH_QUEUE_SIZE requests are already
+waiting, new requests are refused with HashingBusy instead of queueing
+without bound.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import record_bcrypt
+from perprocess import per_process
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "8"))
+HASH_RETRY_AFTER = 1  # seconds, sent with the 503
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+_lock = threading.Lock()
+_stats = {
+    "hashes": 0,
+    "checks": 0,
+    "rejected": 0,
+    "queue_wait_seconds": 0.0,
+    "hash_seconds": 0.0,
+}
+
+
+@per_process
+def _get_executor():
+    return ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
+
+def _run(kind, fn, *args):
+    if not _slots.acquire(blocking=False):
+        with _lock:
+            _stats["rejected"] += 1
+        raise HashingBusy("Password hashing is saturated")
+
+    enqueued = time.perf_counter()
+    elapsed = []
+
+    def timed():
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            elapsed.append(finished - started)
+            with _lock:
+                _stats[kind] += 1
+                _stats["queue_wait_seconds"] += started - enqueued
+                _stats["hash_seconds"] += finished - started
+
+    try:
+        future = _get_executor().submit(timed)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    try:
+        return future.result()
+    finally:
+        if elapsed:
+            record_bcrypt(elapsed[0], kind)
+
+
+def hash_password(password):
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return _run("hashes", bcrypt.hashpw, password.encode(), salt).decode("utf-8")
+
+
+def check_password(password, hashed):
+    return _run("checks", bcrypt.checkpw, password.encode(), hashed.encode())
+
+
+def needs_rehash(hashed):
+    # bcrypt hashes look like $2b$12$<salt+hash>; the second field is the cost.
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+def hash_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["rounds"] = BCRYPT_ROUNDS
+    stats["workers"] = HASH_WORKERS
+    stats["queue_size"] = HASH_QUEUE_SIZE
+    return stats
@@ -0,0 +1,39 @@
+"""Lazily created, per-process singletons.
+
+gunicorn imports the app in the master and then forks the workers.
+Threads do not survive a fork, and sockets opened before it would be
+shared, so background threads, executors and pools are started on first
+use in each process instead of at import time:
+
+    @per_process
+    def get_writer():
+        return AuditWriter()
+
+get_writer() runs the body once per process (under a lock, so
+concurrent first callers share one instance) and returns the same value
+until the process forks again.
+"""
+import os
+import threading
+
+
+class per_process:
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.__doc__ = factory.__doc__
+
+    def __call__(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self.factory()
+                    self._pid = pid
+        return self._value
+
+    def current(self):
+        """The value if this process created it already, else None; never creates it."""
+        return self._value if self._pid == os.getpid() else None
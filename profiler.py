@@ -0,0 +1,190 @@
+"""Development query profiler: per-statement stats and EXPLAIN plans.
+
+Off unless QUERY_PROFILER=1. When on, the pool hands out ProfilingCursor,
+so every statement run through get_db() is tagged with the route it ran
+for (as a leading SQL comment, visible in pg_stat_activity and the
+server log) and a QUERY_PROFILER_SAMPLE fraction of them are aggregated
+per (route, statement): calls, total/max time and rows.
+
+A sampled statement slower than QUERY_PROFILER_SLOW also gets its plan
+captured, at most once per QUERY_PROFILER_EXPLAIN_EVERY seconds per
+statement. Plain SELECTs are run again under EXPLAIN (ANALYZE, BUFFERS);
+anything that could write (or has side effects, like pg_notify or
+nextval) only gets a plain EXPLAIN, inside a savepoint so a failure
+cannot poison the caller's transaction.
+
+Stats are per worker and in memory; /admin/query-profile dumps the top
+offenders of the worker that serves it, so profile with a single worker.
+"""
+import os
+import random
+import re
+import threading
+import time
+
+from psycopg2 import extensions
+
+from metrics import current_route, record_query
+
+PROFILER_ENABLED = os.getenv("QUERY_PROFILER", "0") == "1"
+PROFILER_SAMPLE = float(os.getenv("QUERY_PROFILER_SAMPLE", "1.0"))
+PROFILER_SLOW = float(os.getenv("QUERY_PROFILER_SLOW", "0.05"))
+PROFILER_EXPLAIN_EVERY = float(os.getenv("QUERY_PROFILER_EXPLAIN_EVERY", "60"))
+PROFILER_MAX_STATEMENTS = 5000
+
+EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|EXECUTE)\b", re.I)
+READ_ONLY = re.compile(r"^\s*SELECT\b", re.I)
+SIDE_EFFECTS = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|FOR\s+UPDATE|FOR\s+SHARE|pg_notify|pg_advisory\w*|pg_try_advisory\w*|nextval|setval)\b",
+    re.I
+)
+SEQ_SCAN = re.compile(r"Seq Scan on (?:\w+\.)?(\w+)")
+
+_stats = {}     # (route, statement) -> entry dict
+_untracked = 0
+_lock = threading.Lock()
+
+
+def _normalise(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return " ".join(query.split())
+
+
+class ProfilingCursor(extensions.cursor):
+    """Times, tags, samples and (when slow) explains each statement."""
+
+    def execute(self, query, vars=None):
+        route = current_route()
+        tag = route.replace("%", "%%") if vars is not None else route
+        tagged = f"/* route:{tag} */ {query}" if isinstance(query, str) else query
+        started = time.perf_counter()
+        try:
+            return super().execute(tagged, vars)
+        finally:
+            seconds = time.perf_counter() - started
+            record_query(seconds, query)
+            if random.random() < PROFILER_SAMPLE:
+                _profile(self, route, query, vars, seconds)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            seconds = time.perf_counter() - started
+            record_query(seconds, query)
+            if random.random() < PROFILER_SAMPLE:
+                _profile(self, current_route(), query, None, seconds, explain=False)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            seconds = time.perf_counter() - started
+            record_query(seconds, sql)
+            if random.random() < PROFILER_SAMPLE:
+                _profile(self, current_route(), sql, None, seconds, explain=False)
+
+
+def _profile(cur, route, query, vars, seconds, explain=True):
+    global _untracked
+    statement = _normalise(query)
+    key = (route, statement)
+    with _lock:
+        entry = _stats.get(key)
+        if entry is None:
+            if len(_stats) >= PROFILER_MAX_STATEMENTS:
+                _untracked += 1
+                return
+            entry = _stats[key] = {
+                "route": route, "statement": statement, "calls": 0, "total_seconds": 0.0,
+                "max_seconds": 0.0, "rows": 0, "plan": None, "plan_seconds": None, "explained_at": None,
+            }
+        entry["calls"] += 1
+        entry["total_seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["rows"] += max(cur.rowcount, 0)
+        due = (
+            explain and seconds >= PROFILER_SLOW
+            and (entry["explained_at"] is None or time.monotonic() - entry["explained_at"] >= PROFILER_EXPLAIN_EVERY)
+        )
+        if due:
+            entry["explained_at"] = time.monotonic()
+    if due:
+        plan = _explain(cur, query, vars)
+        if plan is not None:
+            with _lock:
+                entry["plan"] = plan
+                entry["plan_seconds"] = seconds
+
+
+def _explain(cur, query, vars):
+    statement = _normalise(query)
+    # Skip server-side (named) cursors, utility statements and failed transactions
+    if cur.name is not None or not EXPLAINABLE.match(statement):
+        return None
+    conn = cur.connection
+    if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+        return None
+    analyze = READ_ONLY.match(statement) and not SIDE_EFFECTS.search(statement)
+    options = "ANALYZE, BUFFERS" if analyze else "VERBOSE"
+    savepoint = not conn.autocommit
+    explain_cur = extensions.cursor(conn)  # unprofiled, so this does not recurse
+    try:
+        sql = explain_cur.mogrify(query, vars).decode(extensions.encodings.get(conn.encoding, "utf-8"))
+        if savepoint:
+            explain_cur.execute("SAVEPOINT query_profiler")
+        explain_cur.execute(f"EXPLAIN ({options}) {sql}")
+        plan = "\n".join(row[0] for row in explain_cur.fetchall())
+        if savepoint:
+            explain_cur.execute("RELEASE SAVEPOINT query_profiler")
+        return plan
+    except Exception as e:
+        if savepoint:
+            try:
+                explain_cur.execute("ROLLBACK TO SAVEPOINT query_profiler")
+            except Exception:
+                pass
+        print("Query profiler EXPLAIN error:", e)
+        return None
+    finally:
+        explain_cur.close()
+
+
+def top_statements(limit=20, sort="total"):
+    """The worst (route, statement) pairs, with seq scans pulled out of their plans."""
+    keys = {
+        "total": lambda e: e["total_seconds"],
+        "mean": lambda e: e["total_seconds"] / e["calls"],
+        "max": lambda e: e["max_seconds"],
+        "calls": lambda e: e["calls"],
+    }
+    with _lock:
+        entries = [dict(e) for e in _stats.values()]
+        untracked = _untracked
+    entries.sort(key=keys.get(sort, keys["total"]), reverse=True)
+
+    top = []
+    for e in entries[:limit]:
+        top.append({
+            "route": e["route"],
+            "statement": e["statement"],
+            "calls": e["calls"],
+            "total_ms": round(e["total_seconds"] * 1000, 2),
+            "mean_ms": round(e["total_seconds"] / e["calls"] * 1000, 3),
+            "max_ms": round(e["max_seconds"] * 1000, 2),
+            "rows": e["rows"],
+            "seq_scans": sorted(set(SEQ_SCAN.findall(e["plan"] or ""))),
+            "plan_ms": round(e["plan_seconds"] * 1000, 2) if e["plan_seconds"] is not None else None,
+            "plan": e["plan"],
+        })
+    return {"statements": len(entries), "untracked": untracked, "sample": PROFILER_SAMPLE, "top": top}
+
+
+def reset():
+    global _untracked
+    with _lock:
+        _stats.clear()
+        _untracked = 0
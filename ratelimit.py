@@ -0,0 +1,172 @@
+"""Token-bucket rate limits for abuse-prone routes.
+
+Each policy is a list of buckets keyed on one request attribute (email, ip
+or user), written "kind:capacity/period_seconds": capacity requests in a
+burst, refilled evenly over the period. Override a policy with
+RATE_LIMIT_<NAME>, e.g. RATE_LIMIT_OTP="email:3/600,ip:20/600"; an empty
+value disables it.
+
+Every worker keeps its own buckets in memory. With RATE_LIMIT_BACKEND=postgres
+(the default) the limit is enforced on shared buckets in the rate_limits
+table, one statement per key, but a request the local bucket already refuses
+is rejected before touching the database: a worker only sees part of the
+traffic, so its buckets are never emptier than the shared ones. If the
+database is unavailable the shared check fails open.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+from db import PoolTimeout, get_db
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "postgres")  # or "memory"
+RATE_LIMIT_MEMORY_KEYS = int(os.getenv("RATE_LIMIT_MEMORY_KEYS", "100000"))
+RATE_LIMIT_PURGE_INTERVAL = float(os.getenv("RATE_LIMIT_PURGE_INTERVAL", "300"))
+# Trusted proxies in front of the app that append to X-Forwarded-For. The
+# deployment sits behind Render's load balancer (one hop); set 0 only when
+# clients connect directly, or every client shares the proxy's address.
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "1"))
+
+DEFAULT_POLICIES = {
+    # Every route that sends an OTP email draws from the same buckets
+    "otp": "email:3/600,ip:20/600",
+    "claim": "user:20/3600,ip:100/3600",
+}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Rate limit exceeded")
+        self.retry_after = retry_after
+
+
+def parse_policy(spec):
+    buckets = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        kind, _, limit = part.partition(":")
+        capacity, _, period = limit.partition("/")
+        buckets.append((kind, int(capacity), float(period)))
+    return buckets
+
+
+POLICIES = {
+    name: parse_policy(os.getenv(f"RATE_LIMIT_{name.upper()}", spec))
+    for name, spec in DEFAULT_POLICIES.items()
+}
+
+
+class MemoryBuckets:
+    """Per-worker buckets, least recently used evicted past ``max_keys``."""
+
+    def __init__(self, max_keys=RATE_LIMIT_MEMORY_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period, now):
+        """Take a token; returns 0 if allowed, else seconds until one is available."""
+        rate = capacity / period
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def give_back(self, key, capacity):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + 1), updated)
+
+
+# Refill and take in one statement on the server's clock; no row comes back
+# when the bucket is empty.
+TAKE_SQL = """
+INSERT INTO rate_limits AS b (key, tokens, updated_at)
+VALUES (%(key)s, %(capacity)s - 1, now())
+ON CONFLICT (key) DO UPDATE
+SET tokens = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * %(rate)s) - 1,
+    updated_at = now()
+WHERE LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * %(rate)s) >= 1
+RETURNING tokens
+"""
+
+
+class PostgresBuckets:
+    """Buckets shared by every worker, in the UNLOGGED rate_limits table."""
+
+    def __init__(self):
+        self._purged_at = time.monotonic()
+
+    def take_all(self, buckets):
+        """Take a token from every (key, capacity, period) or from none.
+
+        Returns 0 if allowed, else seconds until the first refused bucket refills one token.
+        """
+        with get_db() as conn:
+            cur = conn.cursor()
+            for key, capacity, period in buckets:
+                cur.execute(TAKE_SQL, {"key": key, "capacity": capacity, "rate": capacity / period})
+                if cur.fetchone() is None:
+                    conn.rollback()  # returns the tokens already taken from the other buckets
+                    return period / capacity
+            conn.commit()
+
+            if time.monotonic() - self._purged_at > RATE_LIMIT_PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                self.purge(cur)
+                conn.commit()
+        return 0
+
+    def purge(self, cur):
+        # A bucket left alone for a whole period is full again, same as no row
+        longest = max((period for buckets in POLICIES.values() for _, _, period in buckets), default=0)
+        cur.execute("DELETE FROM rate_limits WHERE updated_at < now() - make_interval(secs => %s)", (longest,))
+
+
+_local = MemoryBuckets()
+_shared = PostgresBuckets() if RATE_LIMIT_BACKEND == "postgres" else None
+
+
+def check(policy, **values):
+    """Spend one token per bucket of ``policy``, or raise RateLimited.
+
+    ``values`` maps bucket kinds to request attributes; kinds with no
+    value (e.g. no email in the body) are not limited.
+    """
+    buckets = [
+        (f"{policy}:{kind}:{values[kind]}", capacity, period)
+        for kind, capacity, period in POLICIES[policy]
+        if values.get(kind) is not None
+    ]
+    if not buckets:
+        return
+
+    now = time.monotonic()
+    for i, (key, capacity, period) in enumerate(buckets):
+        wait = _local.take(key, capacity, period, now)
+        if wait:
+            for taken, taken_capacity, _ in buckets[:i]:
+                _local.give_back(taken, taken_capacity)
+            raise RateLimited(wait)
+
+    if _shared is None:
+        return
+    try:
+        wait = _shared.take_all(buckets)
+    except (psycopg2.Error, PoolTimeout) as e:
+        print("Rate limit backend error:", e)
+        return
+    if wait:
+        for key, capacity, _ in buckets:
+            _local.give_back(key, capacity)
+        raise RateLimited(wait)
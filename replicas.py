@@ -0,0 +1,190 @@
+"""Route read-only requests to streaming replicas.
+
+DATABASE_REPLICA_URLS is a comma-separated list of hot-standby DSNs.
+Read-only routes open their connection with get_read_db(*keys) instead
+of get_db(); with no replicas configured that is just get_db().
+
+Each worker runs one monitor thread that asks every replica for its
+replay lag every REPLICA_LAG_CHECK seconds. A read goes to a random
+replica whose last check is recent and at most REPLICA_MAX_LAG behind,
+and to the primary when none is (or when checking out a replica
+connection fails).
+
+Read-your-writes: a write route calls mark_written(cur, *keys) inside
+its transaction, with keys naming whose reads it affects (a user_ref()
+tuple, ("id", user_id), ("admin",)). For REPLICA_STICKY_SECONDS after
+the commit, reads passing any of those keys go to the primary. The keys
+travel to every worker over NOTIFY; if the listener reconnects, or the
+worker has only just subscribed, notifications may have been missed and
+all reads go to the primary for one sticky window. Keep the window
+comfortably above REPLICA_MAX_LAG + REPLICA_LAG_CHECK.
+
+Trying it locally with a second PostgreSQL instance as a standby:
+
+    pg_basebackup -D /tmp/replica -R -h localhost -U postgres
+    postgres -D /tmp/replica -p 5433 &
+    DATABASE_REPLICA_URLS=postgresql://postgres@localhost:5433/app gunicorn server:app
+
+GET /admin/replicas shows each replica's lag and where reads went.
+"""
+import os
+import random
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from db import PoolTimeout, get_db, get_pool, lease
+from notify import publish, subscribe
+from perprocess import per_process
+
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "1.0"))            # seconds
+REPLICA_LAG_CHECK = float(os.getenv("REPLICA_LAG_CHECK", "1.0"))        # seconds between lag checks
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5.0"))
+REPLICA_CHANNEL = "replica_sticky"
+
+# Replay lag in seconds, 0 when everything received has been replayed. A
+# standby whose WAL receiver is not streaming may be arbitrarily behind
+# while looking caught up, so it reports no lag at all (NULL).
+LAG_SQL = """
+SELECT
+    pg_is_in_recovery(),
+    EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'),
+    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+         ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+_replicas = {dsn: {"lag": None, "checked_at": None, "error": None} for dsn in DATABASE_REPLICA_URLS}
+_sticky = {}            # key -> monotonic time its reads may leave the primary
+_all_sticky_until = 0.0
+_counters = {"replica": 0, "primary": 0, "sticky": 0, "lagging": 0, "fallbacks": 0}
+_lock = threading.Lock()
+
+
+def _key(key):
+    return ":".join(str(part) for part in key)
+
+
+def _remember(payload):
+    global _all_sticky_until
+    until = time.monotonic() + REPLICA_STICKY_SECONDS
+    with _lock:
+        if payload is None:
+            # Listener reconnected: writes announced meanwhile are unknown
+            _all_sticky_until = until
+            return
+        for key in payload.split("\n"):
+            _sticky[key] = until
+        if len(_sticky) > 100000:
+            now = time.monotonic()
+            for key in [k for k, t in _sticky.items() if t <= now]:
+                del _sticky[key]
+
+
+@per_process
+def _ensure_started():
+    for state in _replicas.values():
+        state.update(lag=None, checked_at=None, error=None)
+    threading.Thread(target=_monitor, name="replica-lag", daemon=True).start()
+    subscribe(REPLICA_CHANNEL, _remember)
+    _remember(None)     # writes before we subscribed were not seen either
+
+
+def _monitor():
+    conns = {}
+    while True:
+        for dsn, state in _replicas.items():
+            try:
+                conn = conns.get(dsn)
+                if conn is None or conn.closed:
+                    conn = conns[dsn] = psycopg2.connect(dsn, connect_timeout=max(1, int(REPLICA_LAG_CHECK)))
+                    conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(LAG_SQL)
+                in_recovery, streaming, lag = cur.fetchone()
+                cur.close()
+                if not in_recovery:
+                    raise RuntimeError("not a standby (pg_is_in_recovery() is false)")
+                state.update(
+                    lag=float(lag) if streaming else None,
+                    checked_at=time.monotonic(),
+                    error=None if streaming else "WAL receiver not streaming",
+                )
+            except Exception as e:
+                if state["error"] != str(e):
+                    print("Replica lag check error:", e)
+                state.update(lag=None, checked_at=time.monotonic(), error=str(e))
+                conn = conns.pop(dsn, None)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+        time.sleep(REPLICA_LAG_CHECK)
+
+
+def _count(outcome):
+    with _lock:
+        _counters[outcome] += 1
+
+
+def _choose(keys):
+    """A replica DSN that may serve reads for ``keys``, or None for the primary."""
+    now = time.monotonic()
+    with _lock:
+        if now < _all_sticky_until or any(_sticky.get(_key(k), 0) > now for k in keys):
+            _counters["sticky"] += 1
+            return None
+    healthy = [
+        dsn for dsn, state in _replicas.items()
+        if state["lag"] is not None and state["lag"] <= REPLICA_MAX_LAG
+        and now - state["checked_at"] <= 3 * REPLICA_LAG_CHECK
+    ]
+    if not healthy:
+        _count("lagging")
+        return None
+    return random.choice(healthy)
+
+
+def get_read_db(*keys):
+    """Like get_db(), for a read-only route; ``keys`` as passed to mark_written()."""
+    if DATABASE_REPLICA_URLS:
+        _ensure_started()
+        dsn = _choose(keys)
+        if dsn is not None:
+            try:
+                pool = get_pool(dsn, readonly=True)
+                conn = pool.getconn()
+                _count("replica")
+                return lease(pool, conn)
+            except (psycopg2.Error, PoolTimeout) as e:
+                print("Replica checkout error, reading from the primary:", e)
+                _replicas[dsn].update(lag=None, error=str(e))
+                _count("fallbacks")
+    _count("primary")
+    return get_db()
+
+
+def mark_written(cur, *keys):
+    """Pin reads for ``keys`` to the primary once the caller's transaction commits."""
+    if not DATABASE_REPLICA_URLS or not keys:
+        return
+    _ensure_started()
+    payload = "\n".join(_key(k) for k in keys)
+    publish(cur, REPLICA_CHANNEL, payload)
+    _remember(payload)     # this worker need not wait for its own notification
+
+
+def replica_stats():
+    now = time.monotonic()
+    with _lock:
+        stats = {"reads": dict(_counters), "sticky_keys": sum(1 for t in _sticky.values() if t > now)}
+    stats["replicas"] = [{
+        "lag_seconds": state["lag"],
+        "checked_seconds_ago": round(now - state["checked_at"], 1) if state["checked_at"] else None,
+        "error": state["error"],
+    } for state in _replicas.values()]
+    return stats
@@ -0,0 +1,378 @@
+"""Versioned, forward-only schema migrations.
+
+    python schema.py         # apply pending migrations and exit
+
+Every worker calls ensure_schema() at boot. When the schema is current
+that is two small reads and no locks. Otherwise the first worker to take
+the advisory lock applies the pending steps, each recorded in its own
+transaction, while the others poll for the lock and then find nothing
+left to do. Steps must be idempotent: databases
+created before this table existed replay them all once.
+
+Index builds on live tables are marked @concurrent and run outside a
+transaction with CREATE INDEX CONCURRENTLY, so they never block writes.
+"""
+import time
+from datetime import datetime
+
+import psycopg2
+
+from auditlog import ensure_partitions
+from db import get_db
+
+# pg advisory lock key so only one process migrates at a time
+SCHEMA_LOCK_KEY = 7200
+SCHEMA_LOCK_POLL = 0.2
+
+MIGRATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def concurrent(step):
+    step.concurrent = True
+    return step
+
+
+def column_exists(cur, table, column):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cur.fetchone() is not None
+
+
+def create_base_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            full_name VARCHAR(100) NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            country VARCHAR(100) NOT NULL,
+            password TEXT NOT NULL,
+            pin VARCHAR(4) NOT NULL,
+            btc_balance BIGINT DEFAULT 0,
+            total_earned BIGINT DEFAULT 0,
+            last_mined TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            suspended BOOLEAN DEFAULT FALSE,
+            deleted BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS hashrates (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            hashrate INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            active BOOLEAN NOT NULL DEFAULT TRUE
+        );
+
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            amount BIGINT NOT NULL,
+            wallet TEXT NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS admins (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS otps (
+            id SERIAL PRIMARY KEY,
+            email VARCHAR(100) NOT NULL,
+            code VARCHAR(6) NOT NULL,
+            purpose VARCHAR(50) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+def add_active_hashrate_total(cur):
+    # users.hashrate is the denormalised sum of the user's active grants,
+    # kept current by claim_hashrate() and mining.retire_expired_hashrates().
+    if not column_exists(cur, "hashrates", "active"):
+        cur.execute("ALTER TABLE hashrates ADD COLUMN active BOOLEAN NOT NULL DEFAULT TRUE")
+        cur.execute("UPDATE hashrates SET active = FALSE WHERE expires_at <= %s", (datetime.utcnow(),))
+
+    if not column_exists(cur, "users", "hashrate"):
+        cur.execute("ALTER TABLE users ADD COLUMN hashrate INTEGER NOT NULL DEFAULT 0")
+        cur.execute("""
+            UPDATE users u
+            SET hashrate = a.total
+            FROM (
+                SELECT user_id, SUM(hashrate) AS total
+                FROM hashrates
+                WHERE active
+                GROUP BY user_id
+            ) a
+            WHERE u.id = a.user_id
+        """)
+
+
+def create_index(cur, name, on, unique=False):
+    # A failed CONCURRENTLY build leaves an invalid index behind that
+    # IF NOT EXISTS would happily skip, so drop it and build again.
+    cur.execute("""
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace
+    """, (name,))
+    row = cur.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {on}")
+
+
+@concurrent
+def add_hashrate_indexes(cur):
+    # Accrual, dashboard and listing lookups are all per user, bounded by expiry.
+    create_index(cur, "hashrates_user_expires_idx", "hashrates (user_id, expires_at)")
+    # Expiry sweeps only ever look at grants that are still counted as active.
+    create_index(cur, "hashrates_expiring_idx", "hashrates (expires_at) WHERE active")
+    # ...and the sweeper deletes retired ones in expiry order.
+    create_index(cur, "hashrates_retired_idx", "hashrates (expires_at) WHERE NOT active")
+    create_index(cur, "withdrawals_user_created_idx", "withdrawals (user_id, created_at)")
+
+
+def create_settings(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key VARCHAR(100) PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def column_type(cur, table, column):
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def convert_amounts_to_satoshis(cur):
+    # NUMERIC(16, 8) BTC -> BIGINT satoshis, in place.
+    for table, column in (("users", "btc_balance"), ("users", "total_earned"), ("withdrawals", "amount")):
+        if column_type(cur, table, column) != "numeric":
+            continue
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT")
+        cur.execute(f"""
+            ALTER TABLE {table}
+            ALTER COLUMN {column} TYPE BIGINT USING ROUND({column} * 100000000)::BIGINT
+        """)
+        if table == "users":
+            cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT 0")
+
+
+def add_withdrawal_tracking(cur):
+    cur.execute("ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(100)")
+    cur.execute("ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS processed_at TIMESTAMP")
+
+
+@concurrent
+def add_withdrawal_idempotency_index(cur):
+    # NULL keys never conflict, so requests without a key are unaffected
+    create_index(cur, "withdrawals_idempotency_idx", "withdrawals (user_id, idempotency_key)", unique=True)
+
+
+@concurrent
+def add_withdrawal_status_index(cur):
+    # Admin queue listing and bulk selection filter by status and page by age.
+    create_index(cur, "withdrawals_status_created_idx", "withdrawals (status, created_at, id)")
+
+
+def create_user_logs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_logs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            action TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def create_settlement_runs(cur):
+    # Checkpoints for settle.py
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settlement_runs (
+            id SERIAL PRIMARY KEY,
+            settled_until TIMESTAMP NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            max_user_id INTEGER NOT NULL,
+            users_settled INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+
+def create_rate_limits(cur):
+    # Shared token buckets for ratelimit.py. UNLOGGED: no WAL on the hot
+    # path, and losing the buckets in a crash only resets the limits.
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        )
+    """)
+
+
+def add_otp_expiry(cur):
+    cur.execute("ALTER TABLE otps ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP")
+    cur.execute("ALTER TABLE otps ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+    cur.execute("UPDATE otps SET expires_at = created_at + INTERVAL '10 minutes' WHERE expires_at IS NULL")
+    cur.execute("ALTER TABLE otps ALTER COLUMN expires_at SET NOT NULL")
+    # Only the newest code per (email, purpose) was ever usable
+    cur.execute("""
+        DELETE FROM otps o
+        USING otps newer
+        WHERE newer.email = o.email AND newer.purpose = o.purpose
+          AND (newer.created_at, newer.id) > (o.created_at, o.id)
+    """)
+
+
+@concurrent
+def add_otp_key_index(cur):
+    create_index(cur, "otps_email_purpose_idx", "otps (email, purpose)", unique=True)
+
+
+def partition_user_logs(cur):
+    # Monthly range partitions (maintained by auditlog.py) so old months
+    # can be dropped whole. Audit rows outlive the user, hence no FK.
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('user_logs')")
+    row = cur.fetchone()
+    if row and row[0] == "p":
+        return
+    if row:
+        cur.execute("ALTER TABLE user_logs RENAME TO user_logs_unpartitioned")
+    cur.execute("""
+        CREATE TABLE user_logs (
+            id BIGSERIAL,
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (created_at, id)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # Catches anything outside the monthly partitions
+    cur.execute("CREATE TABLE user_logs_default PARTITION OF user_logs DEFAULT")
+    cur.execute("CREATE INDEX user_logs_user_idx ON user_logs (user_id, created_at)")
+    ensure_partitions(cur, datetime.utcnow())
+    if row:
+        cur.execute("""
+            INSERT INTO user_logs (user_id, action, created_at)
+            SELECT user_id, action, COALESCE(created_at, CURRENT_TIMESTAMP) FROM user_logs_unpartitioned
+        """)
+        cur.execute("DROP TABLE user_logs_unpartitioned")
+
+
+# (version, step). Append only; never renumber or edit an applied step.
+MIGRATIONS = [
+    (1, create_base_tables),
+    (2, add_active_hashrate_total),
+    (3, add_hashrate_indexes),
+    (4, create_settings),
+    (5, convert_amounts_to_satoshis),
+    (6, add_withdrawal_tracking),
+    (7, add_withdrawal_idempotency_index),
+    (8, add_withdrawal_status_index),
+    (9, create_user_logs),
+    (10, create_settlement_runs),
+    (11, create_rate_limits),
+    (12, add_otp_expiry),
+    (13, add_otp_key_index),
+    (14, partition_user_logs),
+]
+
+
+def pending_migrations(cur):
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return list(MIGRATIONS)
+    cur.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cur.fetchall()}
+    return [(version, step) for version, step in MIGRATIONS if version not in applied]
+
+
+def migrate(conn):
+    """Apply pending migrations in order. Returns the versions applied."""
+    cur = conn.cursor()
+    pending = pending_migrations(cur)
+    conn.commit()
+    if not pending:
+        return []
+
+    # Poll rather than block: a session waiting inside pg_advisory_lock holds
+    # a snapshot, and CREATE INDEX CONCURRENTLY in the holder would wait on it.
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (SCHEMA_LOCK_KEY,))
+        locked = cur.fetchone()[0]
+        conn.commit()
+        if locked:
+            break
+        time.sleep(SCHEMA_LOCK_POLL)
+
+    applied = []
+    try:
+        cur.execute(MIGRATIONS_TABLE_SQL)
+        conn.commit()
+        for version, step in pending_migrations(cur):
+            started = time.monotonic()
+            if getattr(step, "concurrent", False):
+                conn.commit()
+                conn.autocommit = True
+                try:
+                    step(cur)
+                finally:
+                    conn.autocommit = False
+            else:
+                step(cur)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, step.__name__)
+            )
+            conn.commit()
+            applied.append(version)
+            print(f"Applied migration {version} ({step.__name__}) in {time.monotonic() - started:.2f}s")
+    finally:
+        try:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_KEY,))
+            conn.commit()
+        except psycopg2.Error:
+            pass  # the session is gone, and its lock with it
+    return applied
+
+
+def ensure_schema():
+    with get_db() as conn:
+        return migrate(conn)
+
+
+if __name__ == "__main__":
+    applied = ensure_schema()
+    print(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
@@ -1,144 +1,72 @@
-import os
-import smtplib
-import random
-import bcrypt
-import psycopg2
+import io
+import csv
+import json
+import math
+from functools import wraps
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import pytz
-from decimal import Decimal
+from db import get_db, pool_stats
+from money import btc_to_sats, sats_to_btc
+from withdrawals import (
+    IDEMPOTENCY_KEY_MAX, AccountSuspended, IdempotencyConflict, InsufficientBalance, request_withdrawal,
+    select_for_update, transition,
+)
+from mailer import EMAIL_FROM, MailQueueFull, send_mail
+from mining import ACTIVE_HASHRATE_SQL, USER_DASHBOARD_STATEMENT, accrue_user, grant_hashrate
+from statements import declare, execute_prepared
+from replicas import get_read_db, mark_written, replica_stats
+from schema import ensure_schema
+from settings_store import get_setting, set_setting
+from announcements import announcement_changed, get_announcement
+from sessions import SessionError, bearer_token, issue_token, revoke_token, verify_token
+from ratelimit import RATE_LIMIT_PROXY_HOPS, RateLimited, check as check_rate_limit
+from auditlog import audit_stats, record as record_audit
+from otps import check_code, discard_code, issue_code
+from metrics import instrument, render as render_metrics
+from profiler import PROFILER_ENABLED, reset as reset_profile, top_statements
+from passwords import HASH_RETRY_AFTER, HashingBusy, check_password, hash_password, hash_stats, needs_rehash
 
 # === CONFIG ===
-EMAIL_FROM = "adchainminer@gmail.com"
-EMAIL_PASSWORD = "zfvn fves admc cgwr"
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
 SITE_NAME = "Adchain Miner"
-DATABASE_URL = os.getenv("DATABASE_URL")  # Make sure to set this env var in your deployment
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, expose_headers=["X-Next-After-Id", "X-Next-Cursor"])
+instrument(app)  # per-route latency histograms and the slow request log
 
 
 # === DB SETUP ===
 
-def get_db():
-    return psycopg2.connect(DATABASE_URL)
-
 def init_db():
-    conn = get_db()
-    cur = conn.cursor()
-
-    # USERS TABLE
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        full_name VARCHAR(100) NOT NULL,
-        email VARCHAR(100) UNIQUE NOT NULL,
-        country VARCHAR(100) NOT NULL,
-        password TEXT NOT NULL,
-        pin VARCHAR(4) NOT NULL,
-        btc_balance NUMERIC(16, 8) DEFAULT 0.0,
-        total_earned NUMERIC(16, 8) DEFAULT 0.0,
-        last_mined TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        suspended BOOLEAN DEFAULT FALSE,
-        deleted BOOLEAN DEFAULT FALSE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-""")
-
-    # HASHRATES TABLE
-    cur.execute("""
-    DROP TABLE IF EXISTS hashrates;
-    CREATE TABLE hashrates (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-        hashrate INTEGER NOT NULL,
-        created_at TIMESTAMP NOT NULL,
-        expires_at TIMESTAMP NOT NULL
-    );
-    """)
-
-    # WITHDRAWALS TABLE
-    cur.execute("""
-    DROP TABLE IF EXISTS withdrawals;
-    CREATE TABLE withdrawals (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-        amount NUMERIC(16, 8) NOT NULL,
-        wallet TEXT NOT NULL,
-        status VARCHAR(20) DEFAULT 'pending',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    # MESSAGES TABLE
-    cur.execute("""
-    DROP TABLE IF EXISTS messages;
-    CREATE TABLE messages (
-        id SERIAL PRIMARY KEY,
-        title TEXT NOT NULL,
-        content TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    # ADMINS TABLE (OPTIONAL)
-    cur.execute("""
-    DROP TABLE IF EXISTS admins;
-    CREATE TABLE admins (
-        id SERIAL PRIMARY KEY,
-        username VARCHAR(100) UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    );
-    """)
-
-    # OTP TABLE
-    cur.execute("""
-    DROP TABLE IF EXISTS otps;
-    CREATE TABLE otps (
-        id SERIAL PRIMARY KEY,
-        email VARCHAR(100) NOT NULL,
-        code VARCHAR(6) NOT NULL,
-        purpose VARCHAR(50) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    conn.commit()
-    conn.close()   
-    
-            
+    # Tables, columns and indexes live in schema.py; when the schema is
+    # already current this is two small reads.
+    ensure_schema()
+
 
 def send_otp(email, code):
+    # Only enqueues; the mail dispatcher thread does the SMTP work.
     subject = f"{SITE_NAME} OTP Verification"
     body = f"Your OTP code is: {code}"
-    msg = MIMEText(body)
-    msg['Subject'] = subject
-    msg['From'] = EMAIL_FROM
-    msg['To'] = email
-
-    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-    server.starttls()
-    server.login(EMAIL_FROM, EMAIL_PASSWORD)
-    server.send_message(msg)
-    server.quit()
-
-def generate_otp():
-    return str(random.randint(100000, 999999))
+    send_mail(email, subject, body)
 
 def log_user_action(user_id, action):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO user_logs (user_id, action) VALUES (%s, %s)",
-        (user_id, action)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    # Buffered; written to user_logs in batches by the audit writer thread
+    record_audit(user_id, action)
+
+def rehash_password(table, key_column, key, password, old_hash):
+    try:
+        new_hash = hash_password(password)
+    except HashingBusy:
+        return  # try again on a later login
+    with get_db() as conn:
+        cur = conn.cursor()
+        # Only replace the hash we verified against, in case it changed meanwhile
+        cur.execute(
+            f"UPDATE {table} SET password = %s WHERE {key_column} = %s AND password = %s",
+            (new_hash, key, old_hash)
+        )
+        conn.commit()
 
 def strong_password(pw):
     import re
@@ -162,26 +90,102 @@ def convert_utc_to_local(dt, timezone_str):
     local_tz = pytz.timezone(timezone_str)
     return dt.replace(tzinfo=utc).astimezone(local_tz)
 
+def request_session():
+    # Signed session from the Authorization header, or None for email-only clients
+    token = bearer_token(request)
+    return verify_token(token) if token else None
+
+def user_ref(email, active=False):
+    """Identify the caller as ("id", user_id) from their session token, else ("email", email).
+
+    Returns None if neither was supplied. With ``active=True`` a token
+    flagged as suspended is refused up front; the routes' own statements
+    refuse accounts suspended since (and email-only callers).
+    """
+    session = request_session()
+    if session:
+        if active and session["s"]:
+            raise AccountSuspended()
+        return "id", session["uid"]
+    if email:
+        return "email", email
+    return None
+
+def client_ip():
+    if RATE_LIMIT_PROXY_HOPS:
+        # Address as seen by the outermost proxy we trust
+        route = request.access_route
+        return route[-min(RATE_LIMIT_PROXY_HOPS, len(route))]
+    return request.remote_addr
+
+def rate_limited(policy):
+    """Charge the request to ``policy``'s buckets before the view does any work."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            raw_email = data.get("email") or data.get("username")
+            email = raw_email.strip().lower() if isinstance(raw_email, str) and raw_email.strip() else None
+            session = request_session()
+            # One bucket per account: its id from the token, else the address it
+            # was given, so nothing is looked up before the limiter has run
+            user = f"id:{session['uid']}" if session else f"email:{email}" if email else None
+            check_rate_limit(policy, email=email, ip=client_ip(), user=user)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Hot statements, prepared once per pooled connection (see statements.py)
+USER_ID_BY_EMAIL = declare("user_id_by_email", "SELECT id FROM users WHERE email = %s")
+SET_BALANCE_BY_EMAIL = declare("set_balance_by_email", "UPDATE users SET btc_balance = %s WHERE email = %s")
+
+# Read-your-writes key for admin reads after admin writes (see replicas.py)
+ADMIN_READS = ("admin",)
+
+def lookup_user_id(cur, ref):
+    column, value = ref
+    if column == "id":
+        return value
+    execute_prepared(cur, USER_ID_BY_EMAIL, (value,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
 # === ROUTES ===
 
+@app.errorhandler(SessionError)
+def invalid_session(e):
+    return jsonify({"error": str(e)}), 401
+
+@app.errorhandler(AccountSuspended)
+def account_suspended(e):
+    return jsonify({"error": "Account suspended."}), 403
+
+@app.errorhandler(RateLimited)
+def rate_limit_exceeded(e):
+    return jsonify({"error": "Too many requests, try again later."}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+
+@app.errorhandler(MailQueueFull)
+def mail_queue_full(e):
+    return jsonify({"error": "Mail service busy, try again shortly."}), 503
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return jsonify({"error": "Server busy, try again shortly."}), 503, {"Retry-After": str(HASH_RETRY_AFTER)}
+
 @app.route("/user/send-otp", methods=["POST"])
+@rate_limited("otp")
 def send_otp_route():
     data = request.json
     email = data.get("email")
-    otp = generate_otp()
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO otps (email, code)
-            VALUES (%s, %s)
-            ON CONFLICT (email) DO UPDATE SET code = EXCLUDED.code, created_at = CURRENT_TIMESTAMP
-        """, (email, otp))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            otp = issue_code(cur, email, "signup")
+            conn.commit()
         send_otp(email, otp)
         return jsonify({"message": "OTP sent successfully."})
+    except MailQueueFull:
+        raise
     except Exception as e:
         print("OTP error:", e)
         return jsonify({"error": "Failed to send OTP."}), 500
@@ -193,16 +197,14 @@ def verify_otp():
     email = data.get("email")
     otp = data.get("otp")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT code FROM otps WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        result = check_code(cur, email, "signup", otp)
+        conn.commit()
 
-    if row and row[0] == otp:
+    if result == "verified":
         return jsonify({"message": "OTP verified."})
-    return jsonify({"error": "Invalid OTP."}), 400
+    return jsonify({"error": "Invalid OTP." if result == "invalid" else "OTP expired, request a new one."}), 400
 
 
 @app.route("/user/create-account", methods=["POST"])
@@ -217,33 +219,29 @@ def create_account():
     if not all([full_name, country, email, password, pin]):
         return jsonify({"error": "All fields required."}), 400
 
-    hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    hashed_password = hash_password(password)
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
-        return jsonify({"error": "Email already registered."}), 409
-
-    try:
-        cur.execute("""
-            INSERT INTO users (full_name, country, email, password, pin)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (full_name, country, email, hashed_password, pin))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print("Create account error:", e)
-        return jsonify({"error": "Account creation failed."}), 500
-    finally:
-        cur.close()
-        conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, USER_ID_BY_EMAIL, (email,))
+        if cur.fetchone():
+            return jsonify({"error": "Email already registered."}), 409
+
+        try:
+            cur.execute("""
+                INSERT INTO users (full_name, country, email, password, pin)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (full_name, country, email, hashed_password, pin))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print("Create account error:", e)
+            return jsonify({"error": "Account creation failed."}), 500
 
     return jsonify({"message": "Account created successfully."})
 
 @app.route("/user/signup", methods=["POST"])
+@rate_limited("otp")
 def user_signup():
     data = request.json
     name = data.get("full_name")  # Changed from full_name
@@ -255,21 +253,15 @@ def user_signup():
         return jsonify({"error": "Weak password. Use alphanumeric and symbol (min 6 chars)."}), 400
 
     # Check if email already exists
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
-        return jsonify({"error": "Email already registered."}), 400
-
-    otp = generate_otp()
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, USER_ID_BY_EMAIL, (email,))
+        if cur.fetchone():
+            return jsonify({"error": "Email already registered."}), 400
 
-    # Save OTP for this email
-    cur.execute("INSERT INTO otps (email, code) VALUES (%s, %s)", (email, otp))
-    conn.commit()
-    cur.close()
-    conn.close()
+        # Save OTP for this email
+        otp = issue_code(cur, email, "signup")
+        conn.commit()
 
     # Send OTP email
     send_otp(email, otp)
@@ -281,15 +273,19 @@ def login():
     email = data.get("email")
     password = data.get("password")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT password FROM users WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT password, id FROM users WHERE email = %s", (email,))
+        row = cur.fetchone()
 
-    if row and bcrypt.checkpw(password.encode(), row[0].encode()):
+    if row and check_password(password, row[0]):
+        if needs_rehash(row[0]):
+            # Cost factor changed since this hash was made; upgrade it in place
+            rehash_password("users", "email", email, password, row[0])
+        log_user_action(row[1], "login")
         return jsonify({"message": "Login successful."})
+    if row:
+        log_user_action(row[1], "login_failed")
     return jsonify({"error": "Invalid credentials."}), 401
 
 
@@ -299,38 +295,44 @@ def verify_login_pin():
     email = data.get("email")
     pin = data.get("pin")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT pin FROM users WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, pin, suspended FROM users WHERE email = %s", (email,))
+        row = cur.fetchone()
 
-    if row and row[0] == pin:
-        return jsonify({"message": "PIN verified."})
+    if row and row[1] == pin:
+        # Send as "Authorization: Bearer <token>" to skip the email lookup on user routes
+        return jsonify({"message": "PIN verified.", "token": issue_token(row[0], row[2])})
     return jsonify({"error": "Incorrect PIN."}), 401
 
 
+@app.post("/user/logout")
+def logout():
+    session = request_session()
+    if session:
+        with get_db() as conn:
+            cur = conn.cursor()
+            revoke_token(cur, session)
+            conn.commit()
+    return jsonify({"message": "Logged out."})
+
+
 @app.route("/user/forgot-password", methods=["POST"])
+@rate_limited("otp")
 def forgot_password():
     data = request.json
     email = data.get("email")
-    otp = generate_otp()
 
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO otps (email, code)
-            VALUES (%s, %s)
-            ON CONFLICT (email) DO UPDATE SET code = EXCLUDED.code, created_at = CURRENT_TIMESTAMP
-        """, (email, otp))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            otp = issue_code(cur, email, "reset_password")
+            conn.commit()
 
         send_otp(email, otp)
         return jsonify({"message": "OTP sent."})
+    except MailQueueFull:
+        raise
     except Exception as e:
         print("Forgot password error:", e)
         return jsonify({"error": "Could not send OTP."}), 500
@@ -342,16 +344,14 @@ def verify_password_otp():
     email = data.get("email")
     otp = data.get("otp")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT code FROM otps WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        result = check_code(cur, email, "reset_password", otp)
+        conn.commit()
 
-    if row and row[0] == otp:
+    if result == "verified":
         return jsonify({"message": "OTP verified."})
-    return jsonify({"error": "Invalid OTP."}), 400
+    return jsonify({"error": "Invalid OTP." if result == "invalid" else "OTP expired, request a new one."}), 400
 
 
 @app.route("/user/reset-password", methods=["POST"])
@@ -360,38 +360,32 @@ def reset_password():
     email = data.get("email")
     password = data.get("password")
 
-    hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    hashed_password = hash_password(password)
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET password = %s WHERE email = %s", (hashed_password, email))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET password = %s WHERE email = %s", (hashed_password, email))
+        conn.commit()
 
     return jsonify({"message": "Password reset successful."})
 
 
 @app.route("/user/sendresetpin", methods=["POST"])
+@rate_limited("otp")
 def send_reset_pin():
     data = request.json
     email = data.get("email")
-    otp = generate_otp()
 
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO otps (email, code)
-            VALUES (%s, %s)
-            ON CONFLICT (email) DO UPDATE SET code = EXCLUDED.code, created_at = CURRENT_TIMESTAMP
-        """, (email, otp))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            otp = issue_code(cur, email, "reset_pin")
+            conn.commit()
 
         send_otp(email, otp)
         return jsonify({"message": "OTP sent to reset PIN."})
+    except MailQueueFull:
+        raise
     except Exception as e:
         print("Send reset pin error:", e)
         return jsonify({"error": "Could not send OTP."}), 500
@@ -403,16 +397,14 @@ def verify_pin_otp():
     email = data.get("email")
     otp = data.get("otp")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT code FROM otps WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        result = check_code(cur, email, "reset_pin", otp)
+        conn.commit()
 
-    if row and row[0] == otp:
+    if result == "verified":
         return jsonify({"message": "OTP verified."})
-    return jsonify({"error": "Invalid OTP."}), 400
+    return jsonify({"error": "Invalid OTP." if result == "invalid" else "OTP expired, request a new one."}), 400
 
 
 @app.route("/user/reset-pin", methods=["POST"])
@@ -421,56 +413,48 @@ def reset_pin():
     email = data.get("email")
     pin = data.get("pin")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET pin = %s WHERE email = %s", (pin, email))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET pin = %s WHERE email = %s", (pin, email))
+        conn.commit()
 
     return jsonify({"message": "PIN reset successful."})
 
 # === MINING
 @app.post("/user/claim-hashrate")
+@rate_limited("claim")
 def claim_hashrate():
     data = request.get_json()
-    email = data.get("email")
+    ref = user_ref(data.get("email"), active=True)
 
-    if not email:
+    if not ref:
         return jsonify({"error": "Email is required"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
+    with get_db() as conn:
+        cur = conn.cursor()
 
-    # Get user ID
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    result = cur.fetchone()
-    if not result:
-        conn.close()
-        return jsonify({"error": "User not found"}), 404
+        # Get user ID (free when the caller sent a session token)
+        user_id = lookup_user_id(cur, ref)
+        if not user_id:
+            return jsonify({"error": "User not found"}), 404
 
-    user_id = result[0]
+        # ✅ Admin-defined hashrate, served from the per-worker settings cache
+        hashrate_value = get_setting("hashrate_per_ad")
 
-    # ✅ Fetch admin-defined hashrate from settings table
-    cur.execute("SELECT value FROM settings WHERE key = 'hashrate_per_ad'")
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return jsonify({"error": "Hashrate setting not found"}), 500
-
-    hashrate_value = int(row[0])
+        now = datetime.utcnow()
+        expires_at = now + timedelta(hours=24)
 
-    now = datetime.utcnow()
-    expires_at = now + timedelta(hours=24)
+        # Insert hashrate entry and add it to the user's active total
+        granted = grant_hashrate(cur, user_id, hashrate_value, now, expires_at)
+        if granted is None:
+            return jsonify({"error": "User not found"}), 404
+        if not granted:
+            raise AccountSuspended()
+        mark_written(cur, ref, ("id", user_id))
 
-    # Insert hashrate entry
-    cur.execute("""
-        INSERT INTO hashrates (user_id, hashrate, created_at, expires_at)
-        VALUES (%s, %s, %s, %s)
-    """, (user_id, hashrate_value, now, expires_at))
+        conn.commit()
 
-    conn.commit()
-    conn.close()
+    log_user_action(user_id, f"claim_hashrate:{hashrate_value}")
 
     return jsonify({
         "message": f"{hashrate_value} H/s granted for 24 hours.",
@@ -480,35 +464,25 @@ def claim_hashrate():
 
 @app.get("/user/dashboard")
 def user_dashboard():
-    email = request.args.get("email")
-    if not email:
+    ref = user_ref(request.args.get("email"))
+    if not ref:
         return jsonify({"error": "Email is required"}), 400
+    column, user = ref
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Get user data
-    cur.execute("SELECT id, btc_balance, total_earned, last_mined FROM users WHERE email = %s", (email,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return jsonify({"error": "User not found"}), 404
-
-    user_id, btc_balance, total_earned, last_mined = row
+    with get_read_db(ref) as conn:
+        cur = conn.cursor()
 
-    # Get total active hashrate
-    now = datetime.utcnow()
-    cur.execute("""
-        SELECT COALESCE(SUM(hashrate), 0) FROM hashrates
-        WHERE user_id = %s AND expires_at > %s
-    """, (user_id, now))
-    hashrate = cur.fetchone()[0]
+        # Get user data with the maintained active hashrate total
+        execute_prepared(cur, USER_DASHBOARD_STATEMENT[column], {"user": user, "now": datetime.utcnow()})
+        row = cur.fetchone()
+        if not row:
+            return jsonify({"error": "User not found"}), 404
 
-    conn.close()
+        btc_balance, total_earned, last_mined, hashrate = row
 
     return jsonify({
-        "btc_balance": float(btc_balance),
-        "total_earned": float(total_earned),
+        "btc_balance": sats_to_btc(btc_balance),
+        "total_earned": sats_to_btc(total_earned),
         "hashrate": hashrate,
         "last_mined": last_mined.isoformat()
     }), 200
@@ -517,157 +491,122 @@ def user_dashboard():
 def mine_sync():
     try:
         data = request.get_json()
-        email = data.get("email")
+        ref = user_ref(data.get("email"), active=True)
 
-        if not email:
+        if not ref:
             return jsonify({"error": "Email is required"}), 400
 
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Get user info
-        cur.execute("SELECT id, btc_balance, total_earned, last_mined FROM users WHERE email = %s", (email,))
-        user = cur.fetchone()
-        if not user:
-            conn.close()
-            return jsonify({"error": "User not found"}), 404
-
-        user_id, btc_balance, total_earned, last_mined = user
-        now = datetime.utcnow()
-        seconds_elapsed = Decimal(str((now - last_mined).total_seconds()))
-
-        # Get active hashrate
-        cur.execute("""
-            SELECT COALESCE(SUM(hashrate), 0) FROM hashrates
-            WHERE user_id = %s AND expires_at > %s
-        """, (user_id, now))
-        hashrate = cur.fetchone()[0]
-
-        # Mining formula: BTC = hashrate * seconds * factor
-        mining_factor = Decimal("0.00000001")
-        mined_btc = Decimal(str(hashrate)) * seconds_elapsed * mining_factor
+        with get_db() as conn:
+            cur = conn.cursor()
 
-        new_balance = btc_balance + mined_btc
-        new_total = total_earned + mined_btc
+            # Settle everything mined since last_mined in one atomic statement
+            result = accrue_user(cur, *ref)
+            if not result:
+                return jsonify({"error": "User not found"}), 404
+            if result.suspended:
+                raise AccountSuspended()
 
-        cur.execute("""
-            UPDATE users
-            SET btc_balance = %s, total_earned = %s, last_mined = %s
-            WHERE id = %s
-        """, (new_balance, new_total, now, user_id))
-
-        conn.commit()
-        conn.close()
+            # accrue_user only writes when the user was due a settlement
+            if result.settled:
+                mark_written(cur, ref, ("id", result.user_id))
+            conn.commit()
 
         return jsonify({
-            "mined_btc": float(round(mined_btc, 8)),
-            "new_balance": float(round(new_balance, 8)),
-            "hashrate": hashrate
+            "mined_btc": sats_to_btc(result.mined),
+            "new_balance": sats_to_btc(result.balance),
+            "hashrate": result.hashrate
         }), 200
 
+    except (SessionError, AccountSuspended):
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-        
+
 @app.post("/user/withdraw")
 def user_withdraw():
     try:
         data = request.get_json()
-        email = data.get("email")
-        amount = Decimal(str(data.get("amount", 0)))
+        ref = user_ref(data.get("email"), active=True)
+        try:
+            amount = btc_to_sats(data.get("amount", 0))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         wallet = data.get("wallet")
+        # Clients retrying a timed-out request resend the same key and get the original result
+        key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
 
-        if not email or not wallet or amount <= 0:
+        if not ref or not wallet or amount <= 0:
             return jsonify({"error": "All fields are required."}), 400
+        if key is not None and (not isinstance(key, str) or len(key) > IDEMPOTENCY_KEY_MAX):
+            return jsonify({"error": f"Idempotency key must be a string of at most {IDEMPOTENCY_KEY_MAX} characters."}), 400
+
+        with get_db() as conn:
+            cur = conn.cursor()
+
+            # Check balance, debit it and insert the withdrawal record in one statement
+            try:
+                withdrawal = request_withdrawal(cur, *ref, amount, wallet, key, datetime.utcnow())
+            except InsufficientBalance:
+                conn.rollback()
+                return jsonify({"error": "Insufficient balance."}), 400
+            except IdempotencyConflict:
+                conn.rollback()
+                return jsonify({"error": "Idempotency key already used for a different withdrawal."}), 409
+            if not withdrawal:
+                return jsonify({"error": "User not found"}), 404
+            mark_written(cur, ref, ("id", withdrawal.user_id))
+
+            conn.commit()
+
+        if not withdrawal.replayed:
+            log_user_action(withdrawal.user_id, f"withdraw:{withdrawal.id}:{withdrawal.amount}")
+        return jsonify({
+            "message": "Withdrawal request submitted.",
+            "id": withdrawal.id,
+            "status": withdrawal.status,
+            "new_balance": sats_to_btc(withdrawal.balance)
+        }), 200
 
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Get user and balance
-        cur.execute("SELECT id, btc_balance FROM users WHERE email = %s", (email,))
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"error": "User not found"}), 404
-
-        user_id, balance = row
-
-        if amount > balance:
-            conn.close()
-            return jsonify({"error": "Insufficient balance."}), 400
-
-        # Deduct balance and insert withdrawal record
-        new_balance = balance - amount
-
-        cur.execute("UPDATE users SET btc_balance = %s WHERE id = %s", (new_balance, user_id))
-        cur.execute("""
-            INSERT INTO withdrawals (user_id, amount, wallet, status, created_at)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_id, amount, wallet, 'pending', datetime.utcnow()))
-
-        conn.commit()
-        conn.close()
-
-        return jsonify({"message": "Withdrawal request submitted.", "new_balance": float(new_balance)}), 200
-
+    except (SessionError, AccountSuspended):
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-        
+
 @app.get("/user/messages")
 def get_messages():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT title, content, created_at FROM messages ORDER BY created_at DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
-
-    if not row:
-        return jsonify({})  # No announcement available
+    announcement = get_announcement()
 
-    return jsonify({
-        "title": row[0],
-        "content": row[1],
-        "created_at": row[2].isoformat()
-    })
+    response = jsonify(announcement.payload)
+    response.set_etag(announcement.etag)
+    if announcement.last_modified:
+        response.last_modified = announcement.last_modified.replace(tzinfo=pytz.utc)
+    # Let clients keep a copy but revalidate it every time (cheap 304s)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 @app.get("/user/hashrates")
 def get_active_hashrates():
-    email = request.args.get("email")
-    if not email:
+    ref = user_ref(request.args.get("email"))
+    if not ref:
         return jsonify({"error": "Email is required"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Get user ID
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    result = cur.fetchone()
-    if not result:
-        conn.close()
-        return jsonify({"error": "User not found"}), 404
-
-    user_id = result[0]
-
-    # DELETE expired hashrates for this user
-    cur.execute("DELETE FROM hashrates WHERE user_id = %s AND expires_at <= NOW()", (user_id,))
-
-    # Get all non-expired hashrates
-    cur.execute("""
-        SELECT hashrate, expires_at
-        FROM hashrates
-        WHERE user_id = %s
-        ORDER BY expires_at
-    """, (user_id,))
-
-    rows = cur.fetchall()
+    with get_db() as conn:
+        cur = conn.cursor()
 
-    # ✅ Sum up current hashrate
-    total_hashrate = sum(r[0] for r in rows)
+        # Get user ID
+        user_id = lookup_user_id(cur, ref)
+        if not user_id:
+            return jsonify({"error": "User not found"}), 404
 
-    # ✅ Update users table with the total hashrate
-    cur.execute("UPDATE users SET hashrate = %s WHERE id = %s", (total_hashrate, user_id))
+        # Active grants only; expired ones are retired and deleted by sweeper.py
+        cur.execute("""
+            SELECT hashrate, expires_at
+            FROM hashrates
+            WHERE user_id = %s AND expires_at > %s
+            ORDER BY expires_at
+        """, (user_id, datetime.utcnow()))
 
-    conn.commit()
-    conn.close()
+        rows = cur.fetchall()
 
     hashrates = [{
         "hashrate": r[0],
@@ -684,64 +623,60 @@ def update_btc_balance():
 
     if not email or btc_balance is None:
         return jsonify({"error": "Missing fields"}), 400
+    try:
+        btc_balance = btc_to_sats(btc_balance)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE users SET btc_balance = %s
-        WHERE email = %s
-    """, (btc_balance, email))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, SET_BALANCE_BY_EMAIL, (btc_balance, email))
+        mark_written(cur, ("email", email))
+        conn.commit()
 
     return jsonify({"message": "Balance updated."})
 
 @app.get("/user/get-balance")
 def get_user_balance():
-    email = request.args.get("email")
-    if not email:
+    ref = user_ref(request.args.get("email"))
+    if not ref:
         return jsonify({"error": "Email is required"}), 400
+    column, user = ref
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT btc_balance FROM users WHERE email = %s", (email,))
-    row = cur.fetchone()
-    conn.close()
+    with get_read_db(ref) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT btc_balance FROM users WHERE {column} = %s", (user,))
+        row = cur.fetchone()
 
     if row:
-        return jsonify({"btc_balance": float(row[0])})
+        return jsonify({"btc_balance": sats_to_btc(row[0])})
     else:
         return jsonify({"error": "User not found"}), 404
 
 @app.get("/user/withdrawals")
 def get_withdrawals():
-    email = request.args.get("email")
-    if not email:
+    ref = user_ref(request.args.get("email"))
+    if not ref:
         return jsonify({"error": "Email is required"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    result = cur.fetchone()
-    if not result:
-        conn.close()
-        return jsonify({"error": "User not found"}), 404
+    with get_read_db(ref) as conn:
+        cur = conn.cursor()
 
-    user_id = result[0]
+        user_id = lookup_user_id(cur, ref)
+        if not user_id:
+            return jsonify({"error": "User not found"}), 404
 
-    cur.execute("""
-        SELECT amount, wallet, status, created_at
-        FROM withdrawals
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-    """, (user_id,))
+        cur.execute("""
+            SELECT amount, wallet, status, created_at
+            FROM withdrawals
+            WHERE user_id = %s
+            ORDER BY created_at DESC
+        """, (user_id,))
 
-    rows = cur.fetchall()
-    conn.close()
+        rows = cur.fetchall()
 
     withdrawals = [{
-        "amount": float(r[0]),
+        "amount": sats_to_btc(r[0]),
         "wallet": r[1],
         "status": r[2],
         "created_at": r[3].isoformat()
@@ -749,7 +684,81 @@ def get_withdrawals():
 
     return jsonify(withdrawals), 200
 
+# Everything the dashboard page renders, one subquery per field so a
+# request only pays for what it asks for.
+OVERVIEW_FIELDS = {
+    "dashboard": """
+        json_build_object(
+            'btc_balance', u.btc_balance,
+            'total_earned', u.total_earned,
+            'hashrate', """ + ACTIVE_HASHRATE_SQL + """,
+            'last_mined', u.last_mined
+        )""",
+    "balance": """
+        json_build_object('btc_balance', u.btc_balance)""",
+    "hashrates": """
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'hashrate', h.hashrate,
+                    'expires_at', h.expires_at
+                ) ORDER BY h.expires_at), '[]')
+         FROM hashrates h
+         WHERE h.user_id = u.id AND h.expires_at > %(now)s)""",
+    "withdrawals": """
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'amount', w.amount,
+                    'wallet', w.wallet,
+                    'status', w.status,
+                    'created_at', w.created_at
+                ) ORDER BY w.created_at DESC), '[]')
+         FROM withdrawals w
+         WHERE w.user_id = u.id)""",
+}
+
+@app.get("/user/overview")
+def user_overview():
+    # ?fields=dashboard,balance,hashrates,announcement,withdrawals (default: all)
+    requested = request.args.get("fields")
+    fields = requested.split(",") if requested else list(OVERVIEW_FIELDS) + ["announcement"]
+    unknown = [f for f in fields if f not in OVERVIEW_FIELDS and f != "announcement"]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    result = {}
+    db_fields = [f for f in OVERVIEW_FIELDS if f in fields]
+    if db_fields:
+        ref = user_ref(request.args.get("email"))
+        if not ref:
+            return jsonify({"error": "Email is required"}), 400
+        column, user = ref
+
+        with get_read_db(ref) as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT " + ", ".join(OVERVIEW_FIELDS[f] for f in db_fields) +
+                " FROM users u WHERE u." + column + " = %(user)s",
+                {"user": user, "now": datetime.utcnow()}
+            )
+            row = cur.fetchone()
+        if not row:
+            return jsonify({"error": "User not found"}), 404
+        result.update(zip(db_fields, row))
+
+        # Amounts come back from SQL as satoshis
+        for key in ("dashboard", "balance"):
+            if key in result:
+                for field in ("btc_balance", "total_earned"):
+                    if field in result[key]:
+                        result[key][field] = sats_to_btc(result[key][field])
+        for w in result.get("withdrawals", ()):
+            w["amount"] = sats_to_btc(w["amount"])
+
+    if "announcement" in fields:
+        result["announcement"] = get_announcement().payload
+
+    return jsonify(result), 200
+
 @app.post("/admin/send-otp")
+@rate_limited("otp")
 def send_admin_otp():
     try:
         data = request.get_json()
@@ -758,29 +767,23 @@ def send_admin_otp():
         if not username:
             return jsonify({"error": "Username is required"}), 400
 
-        otp = generate_otp()
-
         # Save OTP in your DB (same as your user route)
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO otps (email, code)
-            VALUES (%s, %s)
-            ON CONFLICT (email) DO UPDATE SET code = EXCLUDED.code, created_at = CURRENT_TIMESTAMP
-        """, (username, otp))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            otp = issue_code(cur, username, "admin_signup")
+            conn.commit()
 
         # Send OTP email to central admin email (your EMAIL_FROM)
         send_otp(EMAIL_FROM, otp)
 
         return jsonify({"message": "OTP sent to admin email"}), 200
 
+    except MailQueueFull:
+        raise
     except Exception as e:
         print("Admin OTP error:", e)
         return jsonify({"error": "Failed to send OTP."}), 500
-        
+
 @app.post("/admin/verify-otp")
 def verify_admin_otp():
     try:
@@ -792,47 +795,31 @@ def verify_admin_otp():
         if not username or not password or not otp:
             return jsonify({"error": "All fields are required"}), 400
 
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Fetch saved OTP from DB
-        cur.execute("SELECT code, created_at FROM otps WHERE email = %s", (username,))
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"error": "OTP not found or expired"}), 400
-
-        saved_otp, created_at = row
-
-        # Optional: check OTP expiration (e.g., 5 minutes)
-        if datetime.utcnow() - created_at > timedelta(minutes=5):
-            conn.close()
-            return jsonify({"error": "OTP expired"}), 400
-
-        if otp != saved_otp:
-            conn.close()
-            return jsonify({"error": "Invalid OTP"}), 400
+        with get_db() as conn:
+            cur = conn.cursor()
 
-        # Check if username already exists
-        cur.execute("SELECT id FROM admins WHERE username = %s", (username,))
-        if cur.fetchone():
-            conn.close()
-            return jsonify({"error": "Username already exists"}), 400
+            # Consumes the OTP only if the admin is created below
+            result = check_code(cur, username, "admin_signup", otp)
+            if result != "verified":
+                conn.commit()  # keep the spent attempt
+                if result == "expired":
+                    return jsonify({"error": "OTP not found or expired"}), 400
+                return jsonify({"error": "Invalid OTP"}), 400
 
-        # Create admin user with hashed password
-        hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode("utf-8")
-        cur.execute("INSERT INTO admins (username, password) VALUES (%s, %s)", (username, hashed_pw))
-        conn.commit()
+            # Check if username already exists
+            cur.execute("SELECT id FROM admins WHERE username = %s", (username,))
+            if cur.fetchone():
+                return jsonify({"error": "Username already exists"}), 400
 
-        # Delete used OTP from DB
-        cur.execute("DELETE FROM otps WHERE email = %s", (username,))
-        conn.commit()
-
-        cur.close()
-        conn.close()
+            # Create admin user with hashed password
+            hashed_pw = hash_password(password)
+            cur.execute("INSERT INTO admins (username, password) VALUES (%s, %s)", (username, hashed_pw))
+            conn.commit()
 
         return jsonify({"message": "Admin account created successfully"}), 200
 
+    except HashingBusy:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -846,26 +833,31 @@ def admin_login():
         if not username or not password:
             return jsonify({"error": "Username and password are required"}), 400
 
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT password FROM admins WHERE username = %s", (username,))
-        row = cur.fetchone()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT password FROM admins WHERE username = %s", (username,))
+            row = cur.fetchone()
 
         if not row:
             return jsonify({"error": "Admin not found"}), 404
 
         stored_hash = row[0]
-        if not bcrypt.checkpw(password.encode(), stored_hash.encode()):
+        if not check_password(password, stored_hash):
             return jsonify({"error": "Incorrect password"}), 401
 
+        if needs_rehash(stored_hash):
+            rehash_password("admins", "username", username, password, stored_hash)
+
         return jsonify({"message": "Login successful"}), 200
 
+    except HashingBusy:
+        raise
     except Exception as e:
         print("Login error:", e)
         return jsonify({"error": "Internal server error"}), 500
 
 @app.post("/admin/send-reset-otp")
+@rate_limited("otp")
 def send_reset_otp():
     try:
         data = request.get_json()
@@ -874,26 +866,19 @@ def send_reset_otp():
         if not username:
             return jsonify({"error": "Username is required"}), 400
 
-        # Generate OTP
-        otp = generate_otp()
-
         # Store OTP in otps table
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO otps (email, code)
-            VALUES (%s, %s)
-            ON CONFLICT (email) DO UPDATE SET code = EXCLUDED.code, created_at = CURRENT_TIMESTAMP
-        """, (username, otp))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            otp = issue_code(cur, username, "admin_reset")
+            conn.commit()
 
         # Send OTP to admin email
         send_otp(EMAIL_FROM, otp)
 
         return jsonify({"message": "OTP sent to admin email"}), 200
 
+    except MailQueueFull:
+        raise
     except Exception as e:
         print("Reset OTP error:", e)
         return jsonify({"error": "Failed to send reset OTP"}), 500
@@ -908,25 +893,16 @@ def verify_reset_otp():
         if not username or not otp:
             return jsonify({"error": "Username and OTP are required"}), 400
 
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT code, created_at FROM otps WHERE email = %s", (username,))
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"error": "OTP not found"}), 400
+        with get_db() as conn:
+            cur = conn.cursor()
+            result = check_code(cur, username, "admin_reset", otp)
+            conn.commit()
 
-        saved_otp, created_at = row
-        if otp != saved_otp:
-            conn.close()
+        if result == "expired":
+            return jsonify({"error": "OTP not found or expired"}), 400
+        if result == "invalid":
             return jsonify({"error": "Invalid OTP"}), 400
 
-        # Check if OTP expired (optional)
-        if datetime.utcnow() - created_at > timedelta(minutes=10):
-            conn.close()
-            return jsonify({"error": "OTP expired"}), 400
-
-        conn.close()
         return jsonify({"message": "OTP verified"}), 200
 
     except Exception as e:
@@ -943,75 +919,169 @@ def update_admin_password():
         if not username or not new_password:
             return jsonify({"error": "Username and new password required"}), 400
 
-        hashed_pw = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode("utf-8")
+        hashed_pw = hash_password(new_password)
 
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("UPDATE admins SET password = %s WHERE username = %s", (hashed_pw, username))
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE admins SET password = %s WHERE username = %s", (hashed_pw, username))
 
-        # Clean up OTP after successful reset
-        cur.execute("DELETE FROM otps WHERE email = %s", (username,))
-        conn.commit()
-        cur.close()
-        conn.close()
+            # Clean up any reset OTP that was never verified
+            discard_code(cur, username, "admin_reset")
+            conn.commit()
 
         return jsonify({"message": "Password updated successfully"}), 200
 
+    except HashingBusy:
+        raise
     except Exception as e:
         print("Password update error:", e)
         return jsonify({"error": "Failed to update password"}), 500
 
+USER_EXPORT_COLUMNS = ["id", "email", "btc_balance", "total_earned", "hashrate", "last_mined"]
+USERS_PAGE_DEFAULT = 100
+USERS_PAGE_MAX = 1000
+USERS_EXPORT_BATCH = 2000
+
+def user_filters(args):
+    clauses, params = [], []
+    for flag in ("suspended", "deleted"):
+        value = args.get(flag)
+        if value is not None:
+            clauses.append(f"{flag} = %s")
+            params.append(value.lower() in ("1", "true", "yes"))
+    return clauses, params
+
+def user_row(user):
+    return {
+        "id": user[0],
+        "email": user[1],
+        "btc_balance": sats_to_btc(user[2]),
+        "total_earned": sats_to_btc(user[3]),
+        "hashrate": user[4],
+        "last_mined": user[5].isoformat() if user[5] else None
+    }
+
+def stream_users(fmt, clauses, params):
+    # Server-side (named) cursor: rows arrive in batches of USERS_EXPORT_BATCH,
+    # so memory stays flat however many users there are.
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    with get_read_db(ADMIN_READS) as conn:
+        cur = conn.cursor(name="admin_users_export")
+        cur.itersize = USERS_EXPORT_BATCH
+        cur.execute(f"""
+            SELECT id, email, btc_balance, total_earned, hashrate, last_mined
+            FROM users
+            {where}
+            ORDER BY id
+        """, params)
+
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(USER_EXPORT_COLUMNS)
+            for user in cur:
+                writer.writerow(user_row(user).values())
+                if buf.tell() > 65536:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            yield buf.getvalue()
+        else:
+            for user in cur:
+                yield json.dumps(user_row(user)) + "\n"
+        cur.close()
+
 @app.get("/admin/users")
 def get_all_users():
     try:
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Query to fetch user details
-        cur.execute("""
-            SELECT id, email, btc_balance, total_earned, hashrate, last_mined
-            FROM users
-        """)
-        users = cur.fetchall()
-        conn.close()
+        clauses, params = user_filters(request.args)
+        fmt = request.args.get("format", "json")
+
+        if fmt in ("ndjson", "csv"):
+            mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+            response = Response(stream_users(fmt, clauses, params), mimetype=mimetype)
+            response.headers["Content-Disposition"] = f"attachment; filename=users.{fmt}"
+            return response
+
+        # Keyset pagination: pass the last id of a page as after_id for the next one
+        try:
+            after_id = int(request.args.get("after_id", 0))
+            limit = max(1, min(int(request.args.get("limit", USERS_PAGE_DEFAULT)), USERS_PAGE_MAX))
+        except ValueError:
+            return jsonify({"error": "Invalid after_id or limit"}), 400
+        clauses.append("id > %s")
+        params.append(after_id)
+
+        with get_read_db(ADMIN_READS) as conn:
+            cur = conn.cursor()
+
+            # Query to fetch user details
+            cur.execute(f"""
+                SELECT id, email, btc_balance, total_earned, hashrate, last_mined
+                FROM users
+                WHERE {' AND '.join(clauses)}
+                ORDER BY id
+                LIMIT %s
+            """, params + [limit])
+            users = cur.fetchall()
 
         # Return users as JSON
-        return jsonify([{
-            "id": user[0],
-            "email": user[1],
-            "btc_balance": float(user[2]),
-            "total_earned": float(user[3]),
-            "hashrate": user[4],
-            "last_mined": user[5].isoformat() if user[5] else None
-        } for user in users])
+        response = jsonify([user_row(user) for user in users])
+        if len(users) == limit:
+            response.headers["X-Next-After-Id"] = str(users[-1][0])
+        return response
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.get("/admin/withdrawal-requests")
-def get_pending_withdrawals():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT w.id, u.email, w.amount, w.wallet, w.status, w.created_at
-        FROM withdrawals w
-        JOIN users u ON w.user_id = u.id
-        WHERE w.status = 'pending'
-        ORDER BY w.created_at DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
+WITHDRAWALS_PAGE_DEFAULT = 100
+WITHDRAWALS_PAGE_MAX = 1000
+WITHDRAWALS_BULK_MAX = 5000
 
-    withdrawals = [{
+def withdrawal_row(row):
+    return {
         "id": row[0],
         "email": row[1],
-        "amount": float(row[2]),
+        "amount": sats_to_btc(row[2]),
         "wallet": row[3],
         "status": row[4],
         "created_at": row[5].isoformat()
-    } for row in rows]
+    }
 
-    return jsonify(withdrawals)
+@app.get("/admin/withdrawal-requests")
+def get_pending_withdrawals():
+    status = request.args.get("status", "pending")
+    try:
+        limit = max(1, min(int(request.args.get("limit", WITHDRAWALS_PAGE_DEFAULT)), WITHDRAWALS_PAGE_MAX))
+        # Keyset pagination, newest first: pass X-Next-Cursor back as ?cursor=
+        cursor = request.args.get("cursor")
+        if cursor:
+            created_at, last_id = cursor.rsplit(",", 1)
+            cursor = (datetime.fromisoformat(created_at), int(last_id))
+    except ValueError:
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+
+    clauses, params = ["w.status = %s"], [status]
+    if cursor:
+        clauses.append("(w.created_at, w.id) < (%s, %s)")
+        params.extend(cursor)
+
+    with get_read_db(ADMIN_READS) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT w.id, u.email, w.amount, w.wallet, w.status, w.created_at
+            FROM withdrawals w
+            JOIN users u ON w.user_id = u.id
+            WHERE {' AND '.join(clauses)}
+            ORDER BY w.created_at DESC, w.id DESC
+            LIMIT %s
+        """, params + [limit])
+        rows = cur.fetchall()
+
+    response = jsonify([withdrawal_row(row) for row in rows])
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = f"{rows[-1][5].isoformat()},{rows[-1][0]}"
+    return response
 
 @app.post("/admin/update-withdrawal")
 def update_withdrawal():
@@ -1021,15 +1091,78 @@ def update_withdrawal():
 
     if status not in ["approved", "rejected"]:
         return jsonify({"error": "Invalid status"}), 400
+    # Same rule as the bulk route: bools, floats and strings are not ids
+    if type(withdrawal_id) is not int:
+        return jsonify({"error": "Invalid withdrawal id"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE withdrawals SET status = %s WHERE id = %s", (status, withdrawal_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        # Only pending withdrawals move; rejections refund the user in the same statement
+        outcome = transition(cur, [withdrawal_id], status, datetime.utcnow())[withdrawal_id]
+        mark_written(cur, ADMIN_READS)
+        conn.commit()
 
+    if outcome == "not_found":
+        return jsonify({"error": "Withdrawal not found."}), 404
+    if outcome != status:
+        current = outcome.split(":", 1)[1]
+        return jsonify({"error": f"Withdrawal is already {current}."}), 409
     return jsonify({"message": f"Withdrawal {status}."})
 
+@app.post("/admin/update-withdrawals")
+def update_withdrawals():
+    """Approve or reject many withdrawals in one transaction.
+
+    Body: {"status": ..., "ids": [...]} or {"status": ..., "filter": {...}}
+    where the filter takes status (default pending), older_than_hours,
+    min_amount / max_amount (BTC) and limit. Returns one result per id.
+    """
+    data = request.get_json() or {}
+    status = data.get("status")
+    if status not in ["approved", "rejected"]:
+        return jsonify({"error": "Invalid status"}), 400
+
+    ids = data.get("ids")
+    filters = data.get("filter")
+    if (ids is None) == (filters is None):
+        return jsonify({"error": "Provide either ids or filter."}), 400
+
+    try:
+        if ids is not None:
+            # A string would iterate per character and bools/floats would coerce silently
+            if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+                return jsonify({"error": "ids must be a list of integers."}), 400
+            ids = list(dict.fromkeys(ids))
+            if len(ids) > WITHDRAWALS_BULK_MAX:
+                return jsonify({"error": f"At most {WITHDRAWALS_BULK_MAX} ids per request."}), 400
+        else:
+            hours = filters.get("older_than_hours")
+            min_amount = filters.get("min_amount")
+            max_amount = filters.get("max_amount")
+            selection = {
+                "status": filters.get("status", "pending"),
+                "created_before": datetime.utcnow() - timedelta(hours=float(hours)) if hours is not None else None,
+                "min_amount": btc_to_sats(min_amount) if min_amount is not None else None,
+                "max_amount": btc_to_sats(max_amount) if max_amount is not None else None,
+                "limit": max(1, min(int(filters.get("limit", WITHDRAWALS_BULK_MAX)), WITHDRAWALS_BULK_MAX)),
+            }
+    except (TypeError, ValueError, AttributeError, OverflowError):
+        return jsonify({"error": "Invalid ids or filter"}), 400
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        if ids is None:
+            ids = select_for_update(cur, **selection)
+        outcomes = transition(cur, ids, status, datetime.utcnow()) if ids else {}
+        mark_written(cur, ADMIN_READS)
+        conn.commit()
+
+    results = [{"id": i, "result": outcomes[i]} for i in ids]
+    return jsonify({
+        "updated": sum(1 for r in results if r["result"] == status),
+        "results": results
+    })
+
 @app.post("/admin/add-message")
 def add_message():
     data = request.get_json()
@@ -1039,29 +1172,29 @@ def add_message():
     if not title or not content:
         return jsonify({"error": "Title and content are required."}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
+    with get_db() as conn:
+        cur = conn.cursor()
 
-    # Clear existing message (so only one is always present)
-    cur.execute("DELETE FROM messages")
+        # Clear existing message (so only one is always present)
+        cur.execute("DELETE FROM messages")
 
-    # Insert new message
-    cur.execute("INSERT INTO messages (title, content, created_at) VALUES (%s, %s, %s)",
-                (title, content, datetime.utcnow()))
+        # Insert new message
+        cur.execute("INSERT INTO messages (title, content, created_at) VALUES (%s, %s, %s)",
+                    (title, content, datetime.utcnow()))
+        announcement_changed(cur)
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     return jsonify({"message": "Announcement posted successfully."})
 
 @app.delete("/admin/delete-message")
 def delete_message():
-    conn = get_db()
-    cur = conn.cursor()
+    with get_db() as conn:
+        cur = conn.cursor()
 
-    cur.execute("DELETE FROM messages")
-    conn.commit()
-    conn.close()
+        cur.execute("DELETE FROM messages")
+        announcement_changed(cur)
+        conn.commit()
 
     return jsonify({"message": "Announcement deleted successfully."})
 
@@ -1071,17 +1204,12 @@ def set_hashrate():
         data = request.get_json()
         value = int(data.get("value"))
 
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
 
-        cur.execute("""
-            INSERT INTO settings (key, value)
-            VALUES ('hashrate_per_ad', %s)
-            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-        """, (value,))
+            set_setting(cur, "hashrate_per_ad", value)
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         return jsonify({"message": f"Hashrate per ad updated to {value} H/s."})
 
@@ -1090,18 +1218,49 @@ def set_hashrate():
 
 @app.get("/admin/get-hashrate")
 def get_hashrate():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key = 'hashrate_per_ad'")
-    row = cur.fetchone()
-    conn.close()
+    return jsonify({"hashrate": get_setting("hashrate_per_ad")})
+
+@app.get("/admin/db-pool")
+def get_db_pool_stats():
+    return jsonify(pool_stats())
+
+@app.get("/admin/replicas")
+def get_replica_stats():
+    return jsonify(replica_stats())
+
+@app.get("/admin/hash-stats")
+def get_hash_stats():
+    return jsonify(hash_stats())
+
+@app.get("/admin/audit-stats")
+def get_audit_stats():
+    return jsonify(audit_stats())
+
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/admin/query-profile")
+def get_query_profile():
+    # Development only: 404 unless the server runs with QUERY_PROFILER=1
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Query profiler is disabled."}), 404
+    try:
+        limit = min(int(request.args.get("limit", 20)), 500)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    return jsonify(top_statements(limit, request.args.get("sort", "total")))
+
+@app.post("/admin/query-profile/reset")
+def reset_query_profile():
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Query profiler is disabled."}), 404
+    reset_profile()
+    return jsonify({"message": "Query profile cleared."})
+# Every worker checks the schema at boot, before serving requests
+init_db()
 
-    if row:
-        return jsonify({"hashrate": int(row[0])})
-    else:
-        return jsonify({"hashrate": 100})  # default fallback
 # === RUN SERVER ===
 if __name__ == "__main__":
     import pytz  # required for timezone logic in mining functions
-    init_db()    # make sure all tables are created
     app.run(host="0.0.0.0", port=5000)
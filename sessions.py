@@ -0,0 +1,96 @@
+"""Stateless signed session tokens.
+
+/user/verify-login-pin issues a token carrying the user id and suspension
+flag, so user routes can skip the email -> id lookup. Tokens are checked
+by signature and age only; logouts are remembered in a small per-worker
+LRU that is kept in sync across workers over NOTIFY. The suspension flag
+is a snapshot from login: the statements of routes that must refuse
+suspended users check the users row as well (see server.user_ref).
+
+SESSION_SECRET is required. Every gunicorn worker and the stream.py
+sidecar must verify each other's tokens, so they have to share it.
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from notify import publish, subscribe
+from perprocess import per_process
+
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(24 * 3600)))
+SESSION_REVOCATION_CACHE = int(os.getenv("SESSION_REVOCATION_CACHE", "10000"))
+SESSION_CHANNEL = "session_revoked"
+
+if not SESSION_SECRET:
+    raise RuntimeError("SESSION_SECRET is not set; refusing to start without a shared token secret.")
+
+_serializer = URLSafeTimedSerializer(SESSION_SECRET, salt="user-session")
+
+_revoked_tokens = OrderedDict()    # jti -> revoked at
+_lock = threading.Lock()
+
+
+class SessionError(Exception):
+    pass
+
+
+def _remember(cache, key, value):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > SESSION_REVOCATION_CACHE:
+            cache.popitem(last=False)
+
+
+def _on_revoked(payload):
+    if not payload:
+        return
+    kind, _, rest = payload.partition(":")
+    if kind == "token":
+        _remember(_revoked_tokens, rest, time.time())
+
+
+@per_process
+def subscribe_revocations():
+    """Start following logouts from other workers; verify_token() does this on first use.
+
+    The first call in a process waits (briefly) for the LISTEN, so an
+    event loop should make it from an executor before serving.
+    """
+    subscribe(SESSION_CHANNEL, _on_revoked)
+
+
+def issue_token(user_id, suspended):
+    return _serializer.dumps({"uid": user_id, "s": bool(suspended), "jti": secrets.token_urlsafe(12)})
+
+
+def verify_token(token):
+    """Return the session dict for a valid token, or raise SessionError."""
+    subscribe_revocations()
+    try:
+        session = _serializer.loads(token, max_age=SESSION_TTL)
+    except SignatureExpired:
+        raise SessionError("Session expired")
+    except BadSignature:
+        raise SessionError("Invalid session")
+
+    if session["jti"] in _revoked_tokens:
+        raise SessionError("Session revoked")
+    return session
+
+
+def revoke_token(cur, session):
+    _remember(_revoked_tokens, session["jti"], time.time())
+    publish(cur, SESSION_CHANNEL, f"token:{session['jti']}")
+
+
+def bearer_token(request):
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[7:].strip() or None
+    return None
@@ -0,0 +1,61 @@
+"""Typed, per-worker cached access to the settings table.
+
+Values are cached for SETTINGS_TTL seconds. set_setting() sends a
+``settings_changed`` notification so every worker drops its cache as soon
+as the write commits; the TTL only bounds staleness if a notification is
+missed.
+"""
+import os
+
+from db import get_db
+from notify import CachedValue, publish
+from statements import declare, execute_prepared
+
+SETTINGS_TTL = float(os.getenv("SETTINGS_TTL", "300"))
+SETTINGS_CHANNEL = "settings_changed"
+
+# key -> (type, default)
+SETTINGS = {
+    "hashrate_per_ad": (int, 100),
+}
+
+LOAD_SETTINGS = declare("load_settings", "SELECT key, value FROM settings")
+
+def _load():
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, LOAD_SETTINGS)
+        rows = cur.fetchall()
+
+    values = {}
+    for key, raw in rows:
+        if key not in SETTINGS:
+            continue
+        kind, default = SETTINGS[key]
+        try:
+            values[key] = kind(raw)
+        except (TypeError, ValueError):
+            print(f"Invalid value for setting {key}: {raw!r}")
+    return values
+
+
+_settings = CachedValue(SETTINGS_CHANNEL, _load, SETTINGS_TTL)
+
+
+def get_setting(key):
+    kind, default = SETTINGS[key]
+    return _settings.get().get(key, default)
+
+
+def set_setting(cur, key, value):
+    """Validate and store a setting; takes effect everywhere once the caller commits."""
+    kind, default = SETTINGS[key]
+    value = kind(value)
+    cur.execute("""
+        INSERT INTO settings (key, value, updated_at)
+        VALUES (%s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+    """, (key, str(value)))
+    publish(cur, SETTINGS_CHANNEL, key)
+    _settings.invalidate()
+    return value
@@ -0,0 +1,102 @@
+"""Periodic settlement job: accrues mining rewards for every user in bulk.
+
+    python settle.py                 # one pass, resuming an unfinished run
+    python settle.py --interval 60   # keep settling every 60 seconds
+
+Users are settled in id-range chunks of set-based SQL. Each chunk commits
+together with its checkpoint in ``settlement_runs``, so a killed run
+resumes at the next chunk with the same cut-off time instead of starting
+over.
+"""
+import argparse
+import time
+from datetime import datetime
+
+from db import get_db
+from mining import accrue_range
+from schema import ensure_schema
+
+# pg advisory lock key so only one settlement job runs at a time
+SETTLEMENT_LOCK_KEY = 7201
+
+
+def start_or_resume_run(cur):
+    cur.execute("""
+        SELECT id, settled_until, last_user_id, max_user_id
+        FROM settlement_runs
+        WHERE finished_at IS NULL
+        ORDER BY id DESC
+        LIMIT 1
+    """)
+    row = cur.fetchone()
+    if row:
+        print(f"Resuming settlement run {row[0]} from user {row[2]}")
+        return row
+
+    cur.execute("""
+        INSERT INTO settlement_runs (settled_until, max_user_id)
+        SELECT %s, COALESCE(MAX(id), 0) FROM users
+        RETURNING id, settled_until, last_user_id, max_user_id
+    """, (datetime.utcnow(),))
+    return cur.fetchone()
+
+
+def settle_once(chunk_size):
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (SETTLEMENT_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.commit()
+            print("Another settlement run is in progress, skipping.")
+            return
+
+        try:
+            run_id, settled_until, last_user_id, max_user_id = start_or_resume_run(cur)
+            conn.commit()
+
+            total_users = 0
+            started = time.monotonic()
+            while last_user_id < max_user_id:
+                hi = min(last_user_id + chunk_size, max_user_id) + 1
+                users, mined = accrue_range(cur, last_user_id + 1, hi, settled_until)
+                last_user_id = hi - 1
+                cur.execute("""
+                    UPDATE settlement_runs
+                    SET last_user_id = %s, users_settled = users_settled + %s
+                    WHERE id = %s
+                """, (last_user_id, users, run_id))
+                conn.commit()
+                total_users += users
+
+            cur.execute("UPDATE settlement_runs SET finished_at = %s WHERE id = %s", (datetime.utcnow(), run_id))
+            conn.commit()
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SETTLEMENT_LOCK_KEY,))
+            conn.commit()
+
+    print(f"Settlement run {run_id}: {total_users} users settled up to "
+          f"{settled_until.isoformat()} in {time.monotonic() - started:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Settle mining rewards for all users with active hashrates.")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="users per id-range chunk")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between runs (0 = run once)")
+    args = parser.parse_args()
+
+    ensure_schema()
+    while True:
+        try:
+            settle_once(args.chunk_size)
+        except Exception as e:
+            if not args.interval:
+                raise
+            print("Settlement error:", e)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Server-side prepared statements for the hot queries.
+
+A handful of statements (the email -> id lookup, the mine-sync accrual,
+the dashboard read, the settings load) run on nearly every request, and
+PostgreSQL parses, analyses and plans each of them from scratch every
+time. declare() registers such a statement once, at import time, under
+a name; execute_prepared() runs it on a cursor as EXECUTE name (...),
+issuing the PREPARE first on connections that have not seen it yet.
+
+Prepared statements live in the server session, so which ones a
+connection has is tracked on the connection itself (PreparedConnection,
+the pool's connection_factory). A reconnect gives a fresh connection
+with an empty set and everything is re-prepared on first use. If the
+server forgot a statement behind our back (DISCARD ALL, DEALLOCATE, a
+transaction-pooling proxy), the EXECUTE fails with "prepared statement
+does not exist"; when that was the first statement of the transaction
+it is rolled back, re-prepared and retried, otherwise the error reaches
+the caller and the statement is re-prepared next time. A PREPARE that
+finds the name already taken on the server counts as prepared.
+
+SQL is written with the usual psycopg2 placeholders, either all %s or
+all %(name)s, and the parameters are passed the same way as to
+cur.execute(). PostgreSQL infers parameter types from the statement;
+``types`` pins the ones it cannot (or should not) guess. Set
+PREPARED_STATEMENTS=0 to send plain statements instead, e.g. behind
+pgbouncer in transaction mode.
+"""
+import os
+import re
+from collections import namedtuple
+
+from psycopg2 import errors, extensions
+
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"
+
+PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+Statement = namedtuple("Statement", "name sql prepare_sql args")
+
+STATEMENTS = {}     # name -> Statement
+
+
+class PreparedConnection(extensions.connection):
+    """psycopg2 connection that remembers which statements it has prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def declare(name, sql, types=None):
+    """Register ``sql`` as prepared statement ``name`` and return the name.
+
+    ``types`` maps a parameter (its name, or its 0-based position for %s
+    placeholders) to a PostgreSQL type; the others are inferred.
+    """
+    if name in STATEMENTS and STATEMENTS[name].sql != sql:
+        raise ValueError(f"Prepared statement {name} declared twice")
+    types = types or {}
+    args = []   # parameter names (or positions), in $n order
+
+    def number(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) is None:
+            args.append(len(args))
+            return f"${len(args)}"
+        if match.group(1) not in args:
+            args.append(match.group(1))
+        return f"${args.index(match.group(1)) + 1}"
+
+    body = PLACEHOLDER.sub(number, sql)
+    if any(isinstance(a, int) for a in args) and any(isinstance(a, str) for a in args):
+        raise ValueError(f"Prepared statement {name} mixes %s and %(name)s placeholders")
+    signature = f" ({', '.join(types.get(a, 'unknown') for a in args)})" if args else ""
+    STATEMENTS[name] = Statement(name, sql, f"PREPARE {name}{signature} AS {body}", tuple(args))
+    return name
+
+
+def execute_prepared(cur, name, params=None):
+    """Run declared statement ``name`` with ``params`` on ``cur``, preparing it if needed."""
+    statement = STATEMENTS[name]
+    conn = cur.connection
+    prepared = getattr(conn, "prepared", None)
+    if not PREPARED_STATEMENTS or prepared is None or cur.name is not None:
+        return cur.execute(statement.sql, params)
+
+    values = [params[a] for a in statement.args] if statement.args else None
+    execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f"EXECUTE {name}"
+    fresh = conn.autocommit or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+
+    if name not in prepared:
+        _prepare(cur, statement, prepared)
+    try:
+        return cur.execute(execute_sql, values)
+    except errors.InvalidSqlStatementName:
+        # Only this statement is known to be gone; the others may still be prepared.
+        prepared.discard(name)
+        if not fresh:
+            raise
+        if not conn.autocommit:
+            conn.rollback()
+        _prepare(cur, statement, prepared)
+        return cur.execute(execute_sql, values)
+
+
+def _prepare(cur, statement, prepared):
+    conn = cur.connection
+    savepoint = not conn.autocommit and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE
+    if savepoint:
+        cur.execute("SAVEPOINT prepare_statement")
+    try:
+        cur.execute(statement.prepare_sql)
+    except errors.DuplicatePreparedStatement:
+        # Prepared earlier on this session without our knowing: that is fine
+        if savepoint:
+            cur.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+        elif not conn.autocommit:
+            conn.rollback()
+    else:
+        if savepoint:
+            cur.execute("RELEASE SAVEPOINT prepare_statement")
+    prepared.add(statement.name)
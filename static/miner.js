@@ -156,6 +156,7 @@ function verifyLoginPin() {
       if (ok) {
         alert("✅ PIN verified. Welcome back!");
         sessionStorage.setItem("isLoggedIn", "true");
+        sessionStorage.setItem("token", data.token);
         showDashboard();
       } else {
         alert("❌ " + data.error);
@@ -274,6 +275,15 @@ function checkPinLength() {
 }
 
 function logout() {
+  if (balanceStream) balanceStream.close();
+  const token = sessionStorage.getItem("token");
+  if (token) {
+    fetch("https://danoski-backend.onrender.com/user/logout", {
+      method: "POST",
+      headers: { "Authorization": "Bearer " + token },
+      keepalive: true
+    }).catch(err => console.error(err));
+  }
   sessionStorage.clear();
   localStorage.clear();
   window.location.href = "login.html"; // or whatever your login page is
@@ -287,16 +297,58 @@ function showDashboard() {
   document.getElementById("pin-form").style.display = "none";
   document.getElementById("pin-verify-form").style.display = "none";
   document.getElementById("dashboard-page").style.display = "block";
+  startBalanceStream();
 }
 
+// Live balance pushed by the stream sidecar (stream.py). Flask does not
+// serve /user/stream, so when the sidecar is unreachable the dashboard
+// falls back to the local counter instead of retrying forever.
+const STREAM_URL = "https://danoski-backend.onrender.com/user/stream";
+const STREAM_MAX_ERRORS = 3;
+let balanceStream = null;
 let btcValue = 0.00000000;
-setInterval(() => {
+let fallbackCounter = null;
+
+function showBtc() {
   const btcCounter = document.getElementById("btc-counter");
   if (btcCounter) {
-    btcValue += 0.00000001;
     btcCounter.innerText = btcValue.toFixed(8) + " BTC";
   }
-}, 1000);
+}
+
+function startFallbackCounter() {
+  if (fallbackCounter) return;
+  fallbackCounter = setInterval(() => {
+    btcValue += 0.00000001;
+    showBtc();
+  }, 1000);
+}
+
+function startBalanceStream() {
+  const token = sessionStorage.getItem("token");
+  if (balanceStream || fallbackCounter) return;
+  if (!token || typeof EventSource === "undefined") {
+    startFallbackCounter();
+    return;
+  }
+
+  let errors = 0;
+  balanceStream = new EventSource(STREAM_URL + "?token=" + encodeURIComponent(token));
+  balanceStream.onmessage = (event) => {
+    errors = 0;
+    btcValue = JSON.parse(event.data).btc_balance;
+    showBtc();
+  };
+  balanceStream.onerror = (err) => {
+    console.error(err);
+    errors += 1;
+    if (errors >= STREAM_MAX_ERRORS || balanceStream.readyState === EventSource.CLOSED) {
+      balanceStream.close();
+      balanceStream = null;
+      startFallbackCounter();
+    }
+  };
+}
 
 // === DOMContentLoaded Init ===
 document.addEventListener("DOMContentLoaded", () => {
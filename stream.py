@@ -0,0 +1,150 @@
+"""Live balance stream (Server-Sent Events) sidecar.
+
+    python stream.py               # listens on STREAM_HOST:STREAM_PORT
+
+Route GET /user/stream here from the reverse proxy (with response
+buffering off). Browsers connect with
+``new EventSource(".../user/stream?token=<session token>")`` and receive
+their projected balance and hashrate every STREAM_TICK seconds.
+
+Nothing is written to PostgreSQL from here. Balances are projected from
+a per-user rate that is reloaded in bulk, one query for every connected
+user, every STREAM_REFRESH seconds, and straight away once a grant
+expires. Settlement stays with settle.py and mine-sync. Each connection
+is one idle asyncio task, so a single process holds tens of thousands of
+them; raise the open-file limit (ulimit -n) to match.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+from db import get_db
+from mining import MINING_FACTOR, project_users
+from money import sats_to_btc
+from sessions import SessionError, subscribe_revocations, verify_token
+
+STREAM_HOST = os.getenv("STREAM_HOST", "0.0.0.0")
+STREAM_PORT = int(os.getenv("STREAM_PORT", "5001"))
+STREAM_PATH = "/user/stream"
+STREAM_TICK = float(os.getenv("STREAM_TICK", "1"))
+STREAM_REFRESH = float(os.getenv("STREAM_REFRESH", "60"))
+STREAM_REFRESH_BATCH = 5000
+
+_clients = Counter()   # user id -> open connections
+_rates = {}            # user id -> (as_of, balance, hashrate, next_expiry)
+
+
+def _fetch(user_ids, now):
+    with get_db() as conn:
+        return project_users(conn.cursor(), user_ids, now)
+
+
+def _needs_refresh(user_id, now):
+    rate = _rates.get(user_id)
+    return rate is None or (rate[3] is not None and rate[3] <= now)
+
+
+async def refresh_rates():
+    loop = asyncio.get_running_loop()
+    last_full = 0.0
+    while True:
+        await asyncio.sleep(STREAM_TICK)
+        for user_id in [u for u in _rates if u not in _clients]:
+            del _rates[user_id]
+
+        now = datetime.utcnow()
+        full = time.monotonic() - last_full >= STREAM_REFRESH
+        ids = [u for u in _clients if full or _needs_refresh(u, now)]
+        try:
+            for i in range(0, len(ids), STREAM_REFRESH_BATCH):
+                chunk = ids[i:i + STREAM_REFRESH_BATCH]
+                for user_id, (balance, hashrate, next_expiry) in (await loop.run_in_executor(None, _fetch, chunk, now)).items():
+                    _rates[user_id] = (now, balance, hashrate, next_expiry)
+            if full:
+                last_full = time.monotonic()
+        except Exception as e:
+            print("Stream refresh error:", e)
+
+
+def project(user_id, now):
+    rate = _rates.get(user_id)
+    if rate is None:
+        return None
+    as_of, balance, hashrate, next_expiry = rate
+    # Don't extrapolate past the next expiry; the refresh picks up the new rate.
+    until = min(now, next_expiry) if next_expiry else as_of
+    seconds = max((until - as_of).total_seconds(), 0)
+    balance += int(hashrate * seconds * MINING_FACTOR)
+    return {"btc_balance": sats_to_btc(balance), "hashrate": hashrate}
+
+
+async def respond(writer, status, body=""):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+        f"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n{body}".encode()
+    )
+    await writer.drain()
+
+
+async def handle(reader, writer):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        method, target, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+        writer.close()
+        return
+
+    user_id = None
+    try:
+        url = urlsplit(target)
+        if method != "GET" or url.path != STREAM_PATH:
+            await respond(writer, "404 Not Found")
+            return
+        try:
+            session = verify_token(parse_qs(url.query).get("token", [""])[0])
+        except SessionError as e:
+            await respond(writer, "401 Unauthorized", str(e))
+            return
+
+        user_id = session["uid"]
+        _clients[user_id] += 1
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Access-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\n\r\n"
+            b"retry: 5000\n\n"
+        )
+        while True:
+            event = project(user_id, datetime.utcnow())
+            if event is not None:
+                writer.write(f"data: {json.dumps(event)}\n\n".encode())
+            else:
+                writer.write(b": waiting\n\n")
+            await writer.drain()
+            await asyncio.sleep(STREAM_TICK)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        if user_id is not None:
+            _clients[user_id] -= 1
+            if _clients[user_id] <= 0:
+                del _clients[user_id]
+        writer.close()
+
+
+async def main():
+    # Subscribing blocks until the listener is up; do it once, off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, subscribe_revocations)
+    server = await asyncio.start_server(handle, STREAM_HOST, STREAM_PORT, backlog=4096)
+    print(f"Balance stream listening on {STREAM_HOST}:{STREAM_PORT}{STREAM_PATH}")
+    refresher = asyncio.create_task(refresh_rates())
+    async with server:
+        await server.serve_forever()
+    refresher.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""Expiry sweeper for hashrate grants.
+
+    python sweeper.py                 # one pass
+    python sweeper.py --interval 60   # keep sweeping every 60 seconds
+
+Each pass works in bounded batches, committing after every batch:
+
+1. retire grants whose expires_at has passed (hashrates.active = FALSE)
+   and subtract them from users.hashrate;
+2. delete retired grants the user has already been settled past
+   (expires_at <= users.last_mined), so no unpaid mining time is lost.
+"""
+import argparse
+import time
+from datetime import datetime
+
+from db import get_db
+from mining import retire_expired_hashrates
+
+# pg advisory lock key so only one sweeper runs at a time
+SWEEPER_LOCK_KEY = 7202
+
+DELETE_SETTLED_SQL = """
+DELETE FROM hashrates
+WHERE id IN (
+    SELECT h.id
+    FROM hashrates h
+    JOIN users u ON u.id = h.user_id
+    WHERE NOT h.active AND h.expires_at <= u.last_mined
+    ORDER BY h.expires_at
+    LIMIT %s
+    FOR UPDATE OF h SKIP LOCKED
+)
+"""
+
+
+def delete_settled_hashrates(cur, limit):
+    cur.execute(DELETE_SETTLED_SQL, (limit,))
+    return cur.rowcount
+
+
+def sweep_once(batch_size, pause=0):
+    retired = deleted = 0
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (SWEEPER_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.commit()
+            print("Another sweeper is running, skipping.")
+            return
+
+        try:
+            now = datetime.utcnow()
+            while True:
+                n = retire_expired_hashrates(cur, now, batch_size)
+                conn.commit()
+                retired += n
+                if n < batch_size:
+                    break
+                time.sleep(pause)
+
+            while True:
+                n = delete_settled_hashrates(cur, batch_size)
+                conn.commit()
+                deleted += n
+                if n < batch_size:
+                    break
+                time.sleep(pause)
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SWEEPER_LOCK_KEY,))
+            conn.commit()
+
+    print(f"Hashrate sweep: {retired} grants retired, {deleted} deleted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retire and delete expired hashrate grants.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="grants per batch")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between passes (0 = run once)")
+    args = parser.parse_args()
+
+    while True:
+        try:
+            sweep_once(args.batch_size, args.pause)
+        except Exception as e:
+            if not args.interval:
+                raise
+            print("Sweeper error:", e)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from mining import MINE_SYNC_MIN_INTERVAL, MINING_FACTOR, accrue_user, grant_hashrate  # noqa: E402
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def seconds(n):
+    return T0 + timedelta(seconds=n)
+
+
+def stored(cur, user_id):
+    cur.execute("SELECT btc_balance, total_earned, last_mined FROM users WHERE id = %s", (user_id,))
+    return cur.fetchone()
+
+
+def test_accrues_whole_interval(cur, make_user):
+    user_id = make_user(balance=500, last_mined=T0)
+    grant_hashrate(cur, user_id, 100, seconds(-3600), seconds(3600))
+
+    result = accrue_user(cur, "id", user_id, now=seconds(60))
+
+    assert result.settled
+    assert result.mined == 100 * 60 * MINING_FACTOR
+    assert result.balance == 500 + result.mined
+    assert result.hashrate == 100
+    assert stored(cur, user_id) == (result.balance, result.mined, seconds(60))
+
+
+def test_grant_expiring_partway_through(cur, make_user):
+    user_id = make_user(last_mined=T0)
+    grant_hashrate(cur, user_id, 100, seconds(-3600), seconds(10))
+    grant_hashrate(cur, user_id, 7, seconds(-3600), seconds(3600))
+
+    result = accrue_user(cur, "id", user_id, now=seconds(60))
+
+    # The first grant only counts until it expired; it is no longer active
+    assert result.mined == (100 * 10 + 7 * 60) * MINING_FACTOR
+    assert result.hashrate == 7
+
+
+def test_grant_created_after_last_mined(cur, make_user):
+    user_id = make_user(last_mined=T0)
+    grant_hashrate(cur, user_id, 50, seconds(20), seconds(3600))
+
+    result = accrue_user(cur, "id", user_id, now=seconds(60))
+
+    assert result.mined == 50 * 40 * MINING_FACTOR
+    assert result.hashrate == 50
+
+
+def test_grant_expired_before_last_mined_adds_nothing(cur, make_user):
+    user_id = make_user(balance=500, last_mined=T0)
+    grant_hashrate(cur, user_id, 100, seconds(-3600), seconds(-10))
+
+    result = accrue_user(cur, "id", user_id, now=seconds(60))
+
+    assert (result.mined, result.balance, result.hashrate) == (0, 500, 0)
+
+
+def test_second_sync_within_interval_only_projects(cur, make_user):
+    user_id = make_user(balance=500, last_mined=T0)
+    grant_hashrate(cur, user_id, 100, seconds(-3600), seconds(3600))
+
+    first = accrue_user(cur, "id", user_id, now=seconds(60))
+    later = seconds(60) + MINE_SYNC_MIN_INTERVAL / 2
+    second = accrue_user(cur, "id", user_id, now=later)
+
+    assert first.settled
+    assert not second.settled
+    projected = 100 * (later - seconds(60)).total_seconds() * MINING_FACTOR
+    assert second.mined == projected
+    assert second.balance == first.balance + projected
+    # Nothing was written by the second call
+    assert stored(cur, user_id) == (first.balance, first.mined, seconds(60))
+
+
+def test_suspended_user_is_only_projected(cur, make_user):
+    user_id = make_user(balance=500, last_mined=T0, suspended=True)
+    cur.execute(
+        "INSERT INTO hashrates (user_id, hashrate, created_at, expires_at) VALUES (%s, 100, %s, %s)",
+        (user_id, seconds(-3600), seconds(3600)),
+    )
+
+    result = accrue_user(cur, "id", user_id, now=seconds(60))
+
+    assert result.suspended
+    assert not result.settled
+    assert stored(cur, user_id) == (500, 0, T0)
+
+
+def test_suspended_user_gets_no_grant(cur, make_user):
+    user_id = make_user(suspended=True)
+
+    assert grant_hashrate(cur, user_id, 100, T0, seconds(3600)) is False
+    cur.execute("SELECT COUNT(*) FROM hashrates WHERE user_id = %s", (user_id,))
+    assert cur.fetchone()[0] == 0
+
+
+def test_unknown_user(cur):
+    assert accrue_user(cur, "email", "nobody@example.invalid", now=T0) is None
+    assert grant_hashrate(cur, -1, 100, T0, seconds(3600)) is None
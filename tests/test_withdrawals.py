@@ -0,0 +1,108 @@
+from datetime import datetime
+
+import pytest
+
+from withdrawals import AccountSuspended, IdempotencyConflict, InsufficientBalance, request_withdrawal, transition
+
+NOW = datetime(2024, 1, 1, 12, 0, 0)
+WALLET = "bc1qtestwallet"
+
+
+def withdrawal_rows(cur, user_id):
+    cur.execute("SELECT id, amount, status FROM withdrawals WHERE user_id = %s ORDER BY id", (user_id,))
+    return cur.fetchall()
+
+
+def test_request_debits_balance(cur, make_user, balance):
+    user_id = make_user(balance=10_000)
+
+    withdrawal = request_withdrawal(cur, "id", user_id, 4_000, WALLET, None, NOW)
+
+    assert withdrawal.user_id == user_id
+    assert withdrawal.status == "pending"
+    assert withdrawal.balance == 6_000
+    assert not withdrawal.replayed
+    assert balance(user_id) == 6_000
+    assert withdrawal_rows(cur, user_id) == [(withdrawal.id, 4_000, "pending")]
+
+
+def test_insufficient_balance_leaves_no_row(cur, make_user, balance):
+    user_id = make_user(balance=1_000)
+
+    # The route rolls back on InsufficientBalance; a savepoint stands in for that here
+    cur.execute("SAVEPOINT request")
+    with pytest.raises(InsufficientBalance):
+        request_withdrawal(cur, "id", user_id, 1_001, WALLET, "key-1", NOW)
+    cur.execute("ROLLBACK TO SAVEPOINT request")
+
+    assert withdrawal_rows(cur, user_id) == []
+    assert balance(user_id) == 1_000
+
+
+def test_replay_with_same_key_debits_once(cur, make_user, balance):
+    user_id = make_user(balance=10_000)
+
+    first = request_withdrawal(cur, "id", user_id, 3_000, WALLET, "key-1", NOW)
+    again = request_withdrawal(cur, "id", user_id, 3_000, WALLET, "key-1", NOW)
+
+    assert again.replayed
+    assert again.id == first.id
+    assert (again.amount, again.wallet, again.status) == (3_000, WALLET, "pending")
+    assert again.balance == 7_000
+    assert balance(user_id) == 7_000
+    assert len(withdrawal_rows(cur, user_id)) == 1
+
+
+def test_same_key_for_a_different_request_conflicts(cur, make_user, balance):
+    user_id = make_user(balance=10_000)
+    request_withdrawal(cur, "id", user_id, 3_000, WALLET, "key-1", NOW)
+
+    with pytest.raises(IdempotencyConflict):
+        request_withdrawal(cur, "id", user_id, 5_000, WALLET, "key-1", NOW)
+
+    assert balance(user_id) == 7_000
+    assert len(withdrawal_rows(cur, user_id)) == 1
+
+
+def test_keys_are_per_user(cur, make_user):
+    alice, bob = make_user(balance=10_000), make_user(balance=10_000)
+
+    a = request_withdrawal(cur, "id", alice, 1_000, WALLET, "key-1", NOW)
+    b = request_withdrawal(cur, "id", bob, 1_000, WALLET, "key-1", NOW)
+
+    assert not b.replayed
+    assert a.id != b.id
+
+
+def test_suspended_account_is_refused(cur, make_user, balance):
+    user_id = make_user(balance=10_000, suspended=True)
+
+    with pytest.raises(AccountSuspended):
+        request_withdrawal(cur, "id", user_id, 1_000, WALLET, None, NOW)
+
+    assert withdrawal_rows(cur, user_id) == []
+    assert balance(user_id) == 10_000
+
+
+def test_unknown_user(cur):
+    assert request_withdrawal(cur, "email", "nobody@example.invalid", 1_000, WALLET, "key-1", NOW) is None
+
+
+def test_rejection_refunds_once(cur, make_user, balance):
+    user_id = make_user(balance=10_000)
+    withdrawal = request_withdrawal(cur, "id", user_id, 4_000, WALLET, None, NOW)
+
+    assert transition(cur, [withdrawal.id], "rejected", NOW) == {withdrawal.id: "rejected"}
+    assert balance(user_id) == 10_000
+
+    # Already rejected: nothing moves and nothing is refunded twice
+    assert transition(cur, [withdrawal.id], "rejected", NOW) == {withdrawal.id: "invalid_transition:rejected"}
+    assert balance(user_id) == 10_000
+
+
+def test_approval_keeps_the_debit(cur, make_user, balance):
+    user_id = make_user(balance=10_000)
+    withdrawal = request_withdrawal(cur, "id", user_id, 4_000, WALLET, None, NOW)
+
+    assert transition(cur, [withdrawal.id, -1], "approved", NOW) == {withdrawal.id: "approved", -1: "not_found"}
+    assert balance(user_id) == 6_000
@@ -0,0 +1,168 @@
+"""Withdrawal pipeline: guarded debits, idempotent requests and status transitions."""
+from collections import namedtuple
+
+# status -> statuses it may move to
+TRANSITIONS = {
+    "pending": {"approved", "rejected"},
+}
+
+# withdrawals.idempotency_key is VARCHAR(100)
+IDEMPOTENCY_KEY_MAX = 100
+
+Withdrawal = namedtuple("Withdrawal", "id user_id amount wallet status balance replayed")
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+class IdempotencyConflict(Exception):
+    pass
+
+
+class AccountSuspended(Exception):
+    pass
+
+
+# Insert the request and debit the balance in one statement. The debit is
+# guarded by btc_balance >= amount on the locked user row, so concurrent
+# requests cannot overdraw; a retry with the same idempotency key hits the
+# unique index and inserts (and debits) nothing. Suspended accounts insert
+# nothing either.
+_REQUEST_SQL = """
+WITH target AS (
+    SELECT id, suspended FROM users WHERE {column} = %(user)s
+),
+w AS (
+    INSERT INTO withdrawals (user_id, amount, wallet, status, created_at, idempotency_key)
+    SELECT id, %(amount)s, %(wallet)s, 'pending', %(now)s, %(key)s
+    FROM target
+    WHERE NOT suspended
+    ON CONFLICT (user_id, idempotency_key) DO NOTHING
+    RETURNING id, user_id, amount
+),
+debit AS (
+    UPDATE users u
+    SET btc_balance = u.btc_balance - w.amount
+    FROM w
+    WHERE u.id = w.user_id AND u.btc_balance >= w.amount
+    RETURNING u.btc_balance
+)
+SELECT target.id, target.suspended, w.id, debit.btc_balance
+FROM target LEFT JOIN w ON TRUE LEFT JOIN debit ON TRUE
+"""
+
+_REPLAY_SQL = """
+SELECT w.id, w.user_id, w.amount, w.wallet, w.status, u.btc_balance
+FROM withdrawals w
+JOIN users u ON u.id = w.user_id
+WHERE u.{column} = %(user)s AND w.idempotency_key = %(key)s
+"""
+
+REQUEST_SQL = {column: _REQUEST_SQL.format(column=column) for column in ("id", "email")}
+REPLAY_SQL = {column: _REPLAY_SQL.format(column=column) for column in ("id", "email")}
+
+# Move withdrawals to a new status and refund rejected ones, atomically.
+# Only rows whose current status allows the move are touched.
+TRANSITION_SQL = """
+WITH w AS (
+    UPDATE withdrawals
+    SET status = %(status)s, processed_at = %(now)s
+    WHERE id = ANY(%(ids)s) AND status = ANY(%(from)s)
+    RETURNING id, user_id, amount, status
+),
+refund AS (
+    UPDATE users u
+    SET btc_balance = u.btc_balance + r.total
+    FROM (
+        SELECT user_id, SUM(amount) AS total
+        FROM w
+        WHERE status = 'rejected'
+        GROUP BY user_id
+    ) r
+    WHERE u.id = r.user_id
+    RETURNING u.id
+)
+SELECT id FROM w
+"""
+
+
+def request_withdrawal(cur, column, user, amount, wallet, key, now):
+    """Debit ``amount`` satoshis and record a pending withdrawal.
+
+    Returns a Withdrawal, or None if the user does not exist. Raises
+    AccountSuspended, InsufficientBalance (the caller must roll back) or
+    IdempotencyConflict when ``key`` was already used for a different request.
+    """
+    params = {"user": user, "amount": amount, "wallet": wallet, "key": key, "now": now}
+    cur.execute(REQUEST_SQL[column], params)
+    row = cur.fetchone()
+    if not row:
+        return None
+    user_id, suspended, withdrawal_id, balance = row
+    if suspended:
+        raise AccountSuspended()
+    if withdrawal_id is not None:
+        if balance is None:
+            raise InsufficientBalance()
+        return Withdrawal(withdrawal_id, user_id, amount, wallet, "pending", balance, False)
+
+    if key is None:
+        return None
+    cur.execute(REPLAY_SQL[column], params)
+    row = cur.fetchone()
+    if not row:
+        return None
+    withdrawal_id, user_id, old_amount, old_wallet, status, balance = row
+    if (old_amount, old_wallet) != (amount, wallet):
+        raise IdempotencyConflict()
+    return Withdrawal(withdrawal_id, user_id, old_amount, old_wallet, status, balance, True)
+
+
+def transition(cur, ids, status, now):
+    """Move the given withdrawals to ``status``, refunding rejections.
+
+    Returns ``{id: outcome}`` where outcome is ``status`` for rows that
+    moved, ``"not_found"``, or ``"invalid_transition:<current status>"``.
+    """
+    sources = [s for s, targets in TRANSITIONS.items() if status in targets]
+    cur.execute(TRANSITION_SQL, {"ids": list(ids), "status": status, "from": sources, "now": now})
+    moved = {row[0] for row in cur.fetchall()}
+
+    results = {i: status for i in moved}
+    rest = [i for i in ids if i not in moved]
+    if rest:
+        cur.execute("SELECT id, status FROM withdrawals WHERE id = ANY(%s)", (rest,))
+        current = dict(cur.fetchall())
+        for i in rest:
+            results[i] = f"invalid_transition:{current[i]}" if i in current else "not_found"
+    return results
+
+
+def select_for_update(cur, status=None, created_before=None, min_amount=None, max_amount=None, limit=1000):
+    """Lock and return ids of withdrawals matching the filters, oldest first.
+
+    Rows another transaction is already processing are skipped.
+    """
+    clauses, params = [], []
+    if status is not None:
+        clauses.append("status = %s")
+        params.append(status)
+    if created_before is not None:
+        clauses.append("created_at < %s")
+        params.append(created_before)
+    if min_amount is not None:
+        clauses.append("amount >= %s")
+        params.append(min_amount)
+    if max_amount is not None:
+        clauses.append("amount <= %s")
+        params.append(max_amount)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    cur.execute(f"""
+        SELECT id FROM withdrawals
+        {where}
+        ORDER BY created_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, params + [limit])
+    return [row[0] for row in cur.fetchall()]